@@ -0,0 +1,27 @@
+# -*- coding:utf-8 -*-
+"""Throughput of the attr / css accessors::
+
+    $ PYTHONPATH=. python benchmarks/bench_attr.py
+"""
+from __future__ import print_function
+from pyquery import PyQuery
+import timeit
+
+CALLS = [
+    ("d.attr('href')", lambda d: d.attr('href')),
+    ('d.attr.href', lambda d: d.attr.href),
+    ("d.attr['href']", lambda d: d.attr['href']),
+    ("d.css('color')", lambda d: d.css('color')),
+]
+
+
+def main(number=1000000):
+    d = PyQuery('<a href="#" style="color: red">x</a>')
+    for name, func in CALLS:
+        duration = timeit.timeit(lambda: func(d), number=number)
+        print('%-16s %6.2fs for %d calls (%.0f calls/s)' % (
+            name, duration, number, number / duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding:utf-8 -*-
+"""Queries over many files with one to ``cpu_count()`` worker processes::
+
+    $ PYTHONPATH=. python benchmarks/bench_batch.py [files]
+
+Without files, 400 generated pages are written to a temporary directory.
+"""
+from __future__ import print_function
+from pyquery.batch import query_files
+import multiprocessing
+import tempfile
+import shutil
+import timeit
+import sys
+import os
+
+SELECTORS = {'titles': 'h2', 'links': ('a', '@href'),
+             'cells': 'td.price'}
+
+
+def generate(dirname, number=400):
+    row = ('<tr><td><a href="/item/%d">item %d</a></td>'
+           '<td class="price">%d.00</td></tr>')
+    paths = []
+    for i in range(number):
+        path = os.path.join(dirname, '%d.html' % i)
+        with open(path, 'w') as fd:
+            fd.write('<html><body><h2>page %d</h2><table>%s</table>'
+                     '</body></html>' % (i, ''.join(row % (j, j, j)
+                                                    for j in range(500))))
+        paths.append(path)
+    return paths
+
+
+def main(paths):
+    counts = [0] + sorted(set([1, 2, 4, multiprocessing.cpu_count()]))
+    for workers in counts:
+        duration = min(timeit.repeat(
+            lambda: list(query_files(paths, SELECTORS, workers=workers)),
+            number=1, repeat=3))
+        print('%2d workers %6.2fs (%.0f files/s)' % (
+            workers, duration, len(paths) / duration))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        main(sys.argv[1:])
+    else:
+        dirname = tempfile.mkdtemp()
+        try:
+            main(generate(dirname))
+        finally:
+            shutil.rmtree(dirname)
@@ -0,0 +1,30 @@
+# -*- coding:utf-8 -*-
+"""Cost of the callbacks of map / each / filter::
+
+    $ PYTHONPATH=. python benchmarks/bench_callbacks.py
+"""
+from __future__ import print_function
+from pyquery import PyQuery
+import timeit
+
+HTML = '<ul>%s</ul>' % ('<li>x</li>' * 100000)
+
+CALLS = [
+    ('map(lambda i, e: e)', lambda items: items.map(lambda i, e: e)),
+    ('map(lambda: this)',
+     lambda items: items.map(lambda: this)),  # NOQA
+    ('each(lambda i, e: None)', lambda items: items.each(lambda i, e: None)),
+    ('filter(lambda i: i % 2)', lambda items: items.filter(lambda i: i % 2)),
+]
+
+
+def main(number=5):
+    items = PyQuery(HTML)('li')
+    for name, func in CALLS:
+        duration = min(timeit.repeat(lambda: func(items),
+                                     number=number, repeat=3))
+        print('%-26s %7.2fms' % (name, duration / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
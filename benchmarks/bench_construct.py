@@ -0,0 +1,37 @@
+# -*- coding:utf-8 -*-
+"""Cost of the PyQuery objects built by traversal methods::
+
+    $ PYTHONPATH=. python benchmarks/bench_construct.py
+"""
+from __future__ import print_function
+from pyquery import PyQuery
+import timeit
+
+HTML = '<ul>%s</ul>' % ''.join(
+    '<li class="i%d"><a href="#%d">x</a> <span>y</span></li>' % (i % 3, i)
+    for i in range(100))
+
+CALLS = [
+    ('d.eq(0)', lambda d, items: d.eq(0)),
+    ('items.eq(5)', lambda d, items: items.eq(5)),
+    ("d('li')", lambda d, items: d('li')),
+    ("items.filter('.i1')", lambda d, items: items.filter('.i1')),
+    ("items.find('a')", lambda d, items: items.find('a')),
+    ('items.children()', lambda d, items: items.children()),
+    ('items.parent()', lambda d, items: items.parent()),
+    ('items.map(...)', lambda d, items: items.map(lambda i, e: e)),
+    ('list(items.items())', lambda d, items: list(items.items())),
+]
+
+
+def main(number=1000, repeat=7):
+    d = PyQuery(HTML)
+    items = d('li')
+    for name, func in CALLS:
+        duration = min(timeit.repeat(lambda: func(d, items),
+                                     number=number, repeat=repeat))
+        print('%-22s %8.2fus' % (name, duration / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+# -*- coding:utf-8 -*-
+"""Parsing the same document again with and without the document cache::
+
+    $ PYTHONPATH=. python benchmarks/bench_document_cache.py
+"""
+from __future__ import print_function
+from pyquery import PyQuery
+from pyquery.cache import document_cache
+import timeit
+
+DOCUMENT = '<div>%s</div>' % ''.join(
+    '<p class="x">hello <b>%d</b></p><br>' % i for i in range(5000))
+
+
+def main(number=20):
+    for parser in ('xml', 'html'):
+        document = DOCUMENT.replace('<br>', '<br/>' if parser == 'xml'
+                                    else '<br>')
+        for maxsize in (0, 2 ** 27):
+            document_cache.clear()
+            document_cache.maxsize = maxsize
+            duration = min(timeit.repeat(
+                lambda: PyQuery(document, parser=parser),
+                number=number, repeat=3)) / number
+            print('%-4s %-8s %6.2fms per document' % (
+                parser, 'cached' if maxsize else 'uncached', duration * 1e3))
+    print(document_cache.info())
+    document_cache.maxsize = 0
+
+
+if __name__ == '__main__':
+    main()
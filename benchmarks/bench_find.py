@@ -0,0 +1,31 @@
+# -*- coding:utf-8 -*-
+"""Evaluate selections per context element or once per element set::
+
+    $ PYTHONPATH=. python benchmarks/bench_find.py
+"""
+from __future__ import print_function
+from pyquery import PyQuery
+import timeit
+
+HTML = '<ul>%s</ul>' % ''.join(
+    '<li class="i%d"><a href="#%d">x</a> <span>y</span></li>' % (i % 3, i)
+    for i in range(50000))
+
+SELECTORS = ['a', 'a[href]', 'span:contains("y")']
+
+
+def main(number=3):
+    doc = PyQuery(HTML)
+    items = doc('li')
+    for threshold in (float('inf'), 16):
+        PyQuery._set_evaluation_threshold = threshold
+        print('set evaluation threshold:', threshold)
+        for selector in SELECTORS:
+            duration = timeit.timeit(lambda: items.find(selector),
+                                     number=number)
+            print("  d('li').find(%r) %7.2fms" % (
+                selector, duration / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# -*- coding:utf-8 -*-
+"""Repeated construction of the same fragments with and without
+:data:`pyquery.cache.fragment_cache`::
+
+    $ PYTHONPATH=. python benchmarks/bench_fragment_cache.py
+"""
+from __future__ import print_function
+from pyquery import PyQuery
+from pyquery.cache import fragment_cache
+from copy import deepcopy
+from lxml import etree
+import timeit
+
+# a new copy for each call: documents would grow
+TEMPLATE = etree.fromstring('<ul><b>x</b></ul>')
+
+CALLS = [
+    ("PyQuery('<tr>...')",
+     lambda d: PyQuery('<tr><td class="a">1</td><td>2</td></tr>')),
+    ("PyQuery('<p>&nbsp;')", lambda d: PyQuery('<p>a&nbsp;b</p>')),
+    ("append('<li>')", lambda d: d.append('<li class="x"></li>')),
+    ("wrap('<div>')", lambda d: d('b').wrap('<div class="w"></div>')),
+    ("html('<em>')", lambda d: d.html('<em>x</em> y')),
+]
+
+
+def main(number=10000):
+    maxsize = fragment_cache.maxsize
+    for name, func in CALLS:
+        durations = []
+        for size in (0, maxsize):
+            fragment_cache.maxsize = size
+            fragment_cache.clear()
+            # PyQuery objects are collected by the gc
+            durations.append(min(timeit.repeat(
+                lambda: func(PyQuery(deepcopy(TEMPLATE))),
+                setup='import gc; gc.enable()', number=number, repeat=3)))
+        print('%-22s %5.1fus parsed, %5.1fus cached' % (
+            name, durations[0] / number * 1e6, durations[1] / number * 1e6))
+    fragment_cache.maxsize = maxsize
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+# -*- coding:utf-8 -*-
+"""Time of ``import pyquery`` as reported by ``python -X importtime``
+(python 3.7+)::
+
+    $ PYTHONPATH=. python benchmarks/bench_import.py
+"""
+from __future__ import print_function
+import subprocess
+import sys
+
+
+def import_times(code='import pyquery'):
+    """return {module: (self, cumulative)} import times in seconds"""
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stderr=subprocess.STDOUT, universal_newlines=True)
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_time) / 1e6, int(cumulative) / 1e6)
+    return times
+
+
+def main(repeat=5):
+    runs = [import_times() for i in range(repeat)]
+    best = min(runs, key=lambda times: times['pyquery'][1])
+    print('import pyquery: %.1fms' % (best['pyquery'][1] * 1000))
+    # modules imported by the interpreter itself
+    startup = import_times('pass')
+    modules = [item for item in best.items() if item[0] not in startup]
+    slowest = sorted(modules, key=lambda item: -item[1][0])[:10]
+    for name, (self_time, cumulative) in slowest:
+        print('  %-30s %6.1fms' % (name, self_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
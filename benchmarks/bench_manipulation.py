@@ -0,0 +1,35 @@
+# -*- coding:utf-8 -*-
+"""Setting the same markup on large selections::
+
+    $ PYTHONPATH=. python benchmarks/bench_manipulation.py
+"""
+from __future__ import print_function
+from pyquery import PyQuery
+import timeit
+
+FRAGMENT = u'<span class="price">12.00</span> <a href="/buy">buy</a>'
+
+CALLS = [
+    ('html()', lambda d: d.html(FRAGMENT)),
+    ('append()', lambda d: d.append(FRAGMENT)),
+    ('prepend()', lambda d: d.prepend(FRAGMENT)),
+    ('before()', lambda d: d.before(FRAGMENT)),
+    ('after()', lambda d: d.after(FRAGMENT)),
+]
+
+
+def main(elements=5000, repeat=5):
+    html = u'<div>%s</div>' % (u'<p>x</p>' * elements)
+    for name, func in CALLS:
+        durations = []
+        for _ in range(repeat):
+            d = PyQuery(html)('p')
+            start = timeit.default_timer()
+            func(d)
+            durations.append(timeit.default_timer() - start)
+        print('%-10s %7.2fms for %d elements' % (
+            name, min(durations) * 1000, elements))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+"""Parsing with configured lxml parsers::
+
+    $ PYTHONPATH=. python benchmarks/bench_parser_options.py
+"""
+from __future__ import print_function
+from lxml import etree
+from pyquery import PyQuery
+from pyquery.parsers import get_parser
+import timeit
+
+DOCUMENT = '<div>%s</div>' % ''.join(
+    '\n  <p id="p%d">\n    <b>%d</b> <!-- comment -->\n  </p>' % (i, i)
+    for i in range(20))
+
+OPTIONS = {'remove_blank_text': True, 'remove_comments': True,
+           'collect_ids': False}
+
+CALLS = [
+    ('default options', lambda: PyQuery(DOCUMENT, parser='xml')),
+    ('parser_options', lambda: PyQuery(DOCUMENT, parser='xml',
+                                       parser_options=OPTIONS)),
+    ('new parser per call',
+     lambda: etree.fromstring(DOCUMENT, etree.XMLParser(**OPTIONS))),
+    ('get_parser()',
+     lambda: etree.fromstring(DOCUMENT, get_parser('xml', OPTIONS))),
+]
+
+
+def main(number=20000):
+    for name, func in CALLS:
+        duration = min(timeit.repeat(func, number=number, repeat=3))
+        print('%-20s %6.2fs for %d documents (%.0f documents/s)' % (
+            name, duration, number, number / duration))
+    print('elements: %d with the default parser, %d with %r' % (
+        len(PyQuery(DOCUMENT)('*').contents()),
+        len(PyQuery(DOCUMENT, parser_options=OPTIONS)('*').contents()),
+        OPTIONS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding:utf-8 -*-
+"""Compare the native fast path with cssselect/XPath for simple selectors
+and select_many() with one selection per selector::
+
+    $ PYTHONPATH=. python benchmarks/bench_selectors.py
+"""
+from __future__ import print_function
+from pyquery import PyQuery
+import timeit
+
+HTML = '<html><body>%s</body></html>' % ''.join(
+    '<div class="item b%d" id="i%d"><p class="x">t</p>'
+    '<span data-k="%d">s</span></div>' % (i % 7, i, i) for i in range(5000))
+
+SELECTORS = ['p', '#i4000', '.b3', 'div.b3', '[data-k="77"]']
+
+
+def bench(doc, number=20):
+    divs = doc('div')
+    for selector in SELECTORS:
+        select = timeit.timeit(lambda: doc(selector), number=number)
+        filter_ = timeit.timeit(lambda: divs.filter(selector), number=number)
+        print('  %-16s select %7.2fms  filter %7.2fms' % (
+            selector, select / number * 1000, filter_ / number * 1000))
+
+
+def bench_select_many(doc, number=5):
+    selectors = dict(('s%d' % i, '.b%d' % (i % 7)) for i in range(10))
+    selectors.update(('t%d' % i, tag) for i, tag in enumerate(
+        ['p', 'span', 'div', 'h1', 'ul', 'li', 'a', 'em', 'img', 'table']))
+    selectors.update(('i%d' % i, '#i%d' % (i * 400)) for i in range(10))
+    one_by_one = timeit.timeit(
+        lambda: dict((k, doc(v)) for k, v in selectors.items()),
+        number=number)
+    many = timeit.timeit(lambda: doc.select_many(selectors), number=number)
+    print('%d selectors: one by one %7.2fms  select_many %7.2fms' % (
+        len(selectors), one_by_one / number * 1000, many / number * 1000))
+
+
+def main():
+    doc = PyQuery(HTML)
+    for fast_path in (False, True):
+        PyQuery._fast_path = fast_path
+        print('fast path:', fast_path)
+        bench(doc)
+    bench_select_many(doc)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# -*- coding:utf-8 -*-
+"""Parsing of html pages with and without parser sniffing::
+
+    $ PYTHONPATH=. python benchmarks/bench_sniff.py path/to/pages/*.html
+
+Without sniffing, pages which are not well formed xml are parsed by the
+xml parser until it fails, then by the html parser.
+"""
+from __future__ import print_function
+from pyquery import pyquery
+from pyquery.sniff import sniff_parser
+import timeit
+import sys
+
+
+def main(filenames, repeat=5):
+    pages = []
+    for filename in filenames:
+        with open(filename, 'rb') as fd:
+            pages.append(fd.read())
+    chosen = [sniff_parser(page) for page in pages]
+    print('%d pages, %.1fMB, %d sniffed as html' % (
+        len(pages), sum(len(page) for page in pages) / 1e6,
+        chosen.count('html')))
+
+    def parse():
+        for page in pages:
+            pyquery.fromstring(page)
+
+    sniff = min(timeit.repeat(parse, number=1, repeat=repeat))
+    pyquery.sniff_parser = lambda document: None
+    try:
+        no_sniff = min(timeit.repeat(parse, number=1, repeat=repeat))
+    finally:
+        pyquery.sniff_parser = sniff_parser
+    sniffing = min(timeit.repeat(lambda: [sniff_parser(page)
+                                          for page in pages],
+                                 number=1, repeat=repeat))
+    print('without sniffing %.3fs' % no_sniff)
+    print('with sniffing    %.3fs (%.3fs sniffing)' % (sniff, sniffing))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
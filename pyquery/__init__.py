@@ -5,3 +5,7 @@
 # Distributed under the BSD license, see LICENSE.txt
 
 from .pyquery import PyQuery  # NOQA
+from .pyquery import Selector  # NOQA
+from .streaming import iterparse  # NOQA
+
+compile = PyQuery.compile
@@ -0,0 +1,189 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+"""Run the same queries over many files in worker processes. See
+:func:`query_files`"""
+from .pyquery import PyQuery
+import multiprocessing
+import pickle
+import sys
+
+try:
+    from queue import Empty
+    from queue import Queue
+except ImportError:  # pragma: no cover
+    from Queue import Empty
+    from Queue import Queue
+
+
+def extract(element, what):
+    """Return a picklable value of element (a PyQuery of one element).
+    what is ``'text'``, ``'html'``, ``'outer_html'``, ``'attrib'`` (a dict
+    of the attributes) or ``'@name'`` (the value of the name attribute)::
+
+        >>> p = PyQuery('<p class="x">Hi <b>you</b></p>')
+        >>> print(extract(p, 'text'))
+        Hi you
+        >>> print(extract(p, '@class'))
+        x
+        >>> extract(p, 'attrib')
+        {'class': 'x'}
+    """
+    if what == 'text':
+        return element.text()
+    elif what == 'html':
+        return element.html()
+    elif what == 'outer_html':
+        return element.outer_html()
+    elif what == 'attrib':
+        return dict(element[0].attrib)
+    elif what.startswith('@'):
+        return element.attr(what[1:])
+    raise ValueError('Can not extract "%s"' % what)
+
+
+def _queries(selectors):
+    """(name, selector, what) for each selector"""
+    queries = []
+    for name, selector in sorted(selectors.items()):
+        if isinstance(selector, tuple):
+            selector, what = selector
+        else:
+            what = 'text'
+        queries.append((name, selector, what))
+    return queries
+
+
+def query_file(path, queries, **kwargs):
+    """Return a dict of the values extracted from the file at path"""
+    doc = PyQuery(filename=path, **kwargs)
+    return dict((name, [extract(element, what)
+                        for element in doc(selector).items()])
+                for name, selector, what in queries)
+
+
+def _query_chunk(index, paths, queries, kwargs):
+    """Run in workers. Errors are returned: results and errors are sent
+    back by the same callback"""
+    try:
+        return index, [(path, query_file(path, queries, **kwargs))
+                       for path in paths], None
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            # the callback would never be called
+            e = RuntimeError(repr(e))
+        return index, None, e
+
+
+def _error_callback(done, index):
+    """called by the pool when a chunk could not be sent to a worker (or its
+    result could not be sent back)"""
+    def error_callback(error):
+        done.put((index, None, error))
+    return error_callback
+
+
+def _chunks(paths, chunksize):
+    chunk = []
+    for path in paths:
+        chunk.append(path)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def query_files(paths, selectors, workers=None, chunksize=16, ordered=True,
+                window=None, timeout=None, **kwargs):
+    """Parse each file of paths and run selectors on it in a pool of
+    ``workers`` processes (default: one per cpu). Yield ``(path, results)``
+    where results is a dict of the lists of values extracted for each
+    selector::
+
+        >>> import os
+        >>> selectors = {'hello': '.hello', 'links': ('a', '@href')}
+        >>> path = os.path.join(os.path.dirname(__file__), '..', 'tests',
+        ...                     'test.html')
+        >>> for path, results in query_files([path], selectors, workers=0):
+        ...     print(results['hello'], results['links'])
+        ['Hello world !'] ['http://python.org']
+
+    selectors maps names to a css selector or to a ``(selector, what)``
+    tuple where what is one of the values accepted by :func:`extract`
+    (``'text'`` by default). Trees never leave the workers: only the
+    extracted strings are sent back.
+
+    paths is read lazily and files are sent to workers by chunks of
+    ``chunksize``. At most ``window`` chunks (default: twice the number of
+    workers) are sent or waiting to be consumed, so a slow consumer does
+    not let results pile up. With ``ordered=False`` results are yielded as
+    soon as a chunk is done. An error in a worker is raised by the
+    iterator and the pool is terminated, as when the iterator is closed
+    before the end. A chunk lost by the pool (e.g. its worker was killed) is
+    never done: set ``timeout`` to raise ``multiprocessing.TimeoutError``
+    when no chunk is done for that many seconds. ``workers=0`` runs queries
+    in the current process.
+
+    Other keyword arguments (``parser``, ``parser_options``...) are passed
+    to :class:`~pyquery.pyquery.PyQuery`.
+    """
+    queries = _queries(selectors)
+    if workers == 0:
+        for path in paths:
+            yield path, query_file(path, queries, **kwargs)
+        return
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if window is None:
+        window = 2 * workers
+    chunks = enumerate(_chunks(paths, chunksize))
+    done = Queue()
+    # ordered: chunks done before the ones which precede them
+    waiting = {}
+    next_index = 0
+    pending = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        while True:
+            while pending < window:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                callbacks = {'callback': done.put}
+                if sys.version_info >= (3,):
+                    callbacks['error_callback'] = _error_callback(done,
+                                                                  chunk[0])
+                pool.apply_async(_query_chunk,
+                                 (chunk[0], chunk[1], queries, kwargs),
+                                 **callbacks)
+                pending += 1
+            if not pending:
+                break
+            try:
+                index, results, error = done.get(timeout=timeout)
+            except Empty:
+                raise multiprocessing.TimeoutError(
+                    'No chunk done in %s seconds' % timeout)
+            if error is not None:
+                raise error
+            if ordered:
+                waiting[index] = results
+                ready = []
+                while next_index in waiting:
+                    ready.append(waiting.pop(next_index))
+                    next_index += 1
+            else:
+                ready = [results]
+            for results in ready:
+                pending -= 1
+                for result in results:
+                    yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
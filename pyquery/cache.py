@@ -0,0 +1,200 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+from collections import OrderedDict
+from collections import namedtuple
+from copy import deepcopy
+import hashlib
+import threading
+
+
+CacheInfo = namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """A thread safe, size bounded, least recently used mapping::
+
+        >>> cache = LRUCache(maxsize=2)
+        >>> cache.set('a', 1)
+        >>> cache.set('b', 2)
+        >>> cache.get('a')
+        1
+        >>> cache.set('c', 3)
+        >>> cache.get('b') is None
+        True
+        >>> cache.info()
+        CacheInfo(hits=1, misses=1, evictions=1, maxsize=2, currsize=2)
+
+    ``sizeof`` can be used to weight entries. ``maxsize`` is then the
+    maximum total weight of the cache instead of a number of entries.
+    """
+
+    def __init__(self, maxsize=256, sizeof=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.sizeof is not None else 1
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+                self._size -= self._sizes.pop(key)
+            if size > self.maxsize:
+                return
+            self._data[key] = value
+            self._sizes[key] = size
+            self._size += size
+            while self._size > self.maxsize:
+                old_key, _ = self._data.popitem(last=False)
+                self._size -= self._sizes.pop(old_key)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries and reset counters"""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """Return a :class:`CacheInfo` with the current counters"""
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, self._size)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+#: CSS selector to XPath translations shared by all PyQuery instances
+css_cache = LRUCache(maxsize=1024)
+
+#: compiled ``etree.XPath`` evaluators shared by all PyQuery instances
+xpath_cache = LRUCache(maxsize=1024)
+
+
+def estimated_size(document):
+    """Approximate memory used by the tree of a parsed document: about 256
+    bytes for each tag of its source plus the source length"""
+    lt = b'<' if isinstance(document, bytes) else u'<'
+    return len(document) + 256 * document.count(lt)
+
+
+def document_key(document, parser=None, parser_options=None):
+    """Key of a document in :data:`document_cache`"""
+    if isinstance(document, bytes):
+        data = document
+    else:
+        try:
+            data = document.encode('utf-8')
+        except UnicodeError:
+            data = document.encode('utf-8', 'surrogatepass')
+    return (hashlib.sha1(data).digest(), isinstance(document, bytes),
+            parser, _options_key(parser_options))
+
+
+def fragment_key(markup, parser=None, parser_options=None):
+    """Key of a fragment in :data:`fragment_cache`: short markup is its own
+    key"""
+    return (markup, type(markup), parser, _options_key(parser_options))
+
+
+def _options_key(parser_options):
+    if parser_options is None:
+        return None
+    return tuple(sorted(parser_options.items()))
+
+
+class CachedDocument(object):
+    """Elements returned by a parser, kept in :data:`document_cache`.
+    :meth:`copy` returns copies of them::
+
+        >>> from lxml import etree
+        >>> root = etree.fromstring('<a><b/></a>')
+        >>> cached = CachedDocument([root[0]], 'xml', 1)
+        >>> b = cached.copy()[0]
+        >>> b.tag, b.getparent().tag, b is root[0]
+        ('b', 'a', False)
+
+    The whole document is copied so elements keep their ancestors. Elements
+    must be in the same document.
+    """
+
+    __slots__ = ('root', 'paths', 'parser', 'size')
+
+    def __init__(self, elements, parser, size):
+        self.root = None
+        self.paths = []
+        self.parser = parser
+        self.size = size
+        for element in elements:
+            if not hasattr(element, 'getparent'):
+                # leading text of html fragments
+                self.paths.append(element)
+                continue
+            path = []
+            parent = element.getparent()
+            while parent is not None:
+                path.append(parent.index(element))
+                element, parent = parent, parent.getparent()
+            if self.root is None:
+                self.root = element
+            if (element is not self.root or
+                    element.getroottree().getroot() is not element):
+                raise ValueError('Elements are not in the same document')
+            self.paths.append(tuple(reversed(path)))
+
+    def copy(self):
+        """Return copies of the elements"""
+        if self.root is None:
+            return list(self.paths)
+        root = deepcopy(self.root.getroottree()).getroot()
+        elements = []
+        for path in self.paths:
+            if type(path) is tuple:
+                element = root
+                for index in path:
+                    element = element[index]
+                path = element
+            elements.append(path)
+        return elements
+
+
+#: Documents parsed by an html parser, weighted by :func:`estimated_size`.
+#: Disabled unless ``maxsize`` (in bytes) is set, e.g.
+#: ``document_cache.maxsize = 2 ** 27``. Copying a tree parsed by the xml
+#: parser costs about as much as parsing it again: those are not cached
+#: (but they are hashed)
+document_cache = LRUCache(maxsize=0, sizeof=lambda entry: entry.size)
+
+#: longest markup, in characters, kept in :data:`fragment_cache`
+fragment_max_length = 4096
+
+#: Short markup passed to ``PyQuery()``, ``.html()``, ``.append()``,
+#: ``.wrap()``... weighted by :func:`estimated_size`. Copying a small tree
+#: is 2 to 10 times faster than parsing it. ``maxsize`` is in bytes.
+#: Set it to 0 to disable the cache
+fragment_cache = LRUCache(maxsize=2 ** 22, sizeof=lambda entry: entry.size)
@@ -5,6 +5,8 @@
 # Distributed under the BSD license, see LICENSE.txt
 from __future__ import unicode_literals
 from cssselect import xpath as cssselect_xpath
+from cssselect.parser import CombinedSelector
+from cssselect.parser import parse
 from cssselect.xpath import ExpressionError
 
 XPathExprOrig = cssselect_xpath.XPathExpr
@@ -466,3 +468,57 @@ class JQueryTranslator(cssselect_xpath.HTMLTranslator):
         )
         xpath.add_post_condition(value)
         return xpath
+
+
+# the left side of a combinator, seen from the element on its right side
+reverse_combinators = {
+    ' ': 'ancestor::%s',
+    '>': 'parent::%s',
+    '+': 'preceding-sibling::*[1]/self::%s',
+    '~': 'preceding-sibling::%s',
+}
+
+
+def self_xpath(translator, css, scope=None):
+    """Translate css to an XPath testing the context node. With the
+    ``self::`` prefix, ``translator.css_to_xpath()`` tests the leftmost
+    part of a combined selector on the context node. Here combinators are
+    translated to reverse axes so the rightmost part is tested::
+
+        >>> print(self_xpath(JQueryTranslator(), 'ul > li'))
+        self::li[parent::ul]
+
+    Positional pseudo classes (``:first``...) can't be tested on a single
+    element. Selectors using them are translated as usual.
+
+    scope is an XPath condition added to the leftmost part of combined
+    selectors::
+
+        >>> print(self_xpath(JQueryTranslator(), 'ul > li', 'not(@id)'))
+        self::li[parent::ul[not(@id)]]
+    """
+    xpaths = []
+    for selector in parse(css):
+        tree = selector.parsed_tree
+        if selector.pseudo_element or not isinstance(tree, CombinedSelector):
+            xpaths.append(translator.selector_to_xpath(
+                selector, 'self::', translate_pseudo_elements=True))
+            continue
+        xpath = 'self::%s' % _reverse_xpath(translator, tree, scope)
+        if 'position()' in xpath or 'last()' in xpath:
+            xpath = translator.selector_to_xpath(
+                selector, 'self::', translate_pseudo_elements=True)
+        xpaths.append(xpath)
+    return ' | '.join(xpaths)
+
+
+def _reverse_xpath(translator, tree, scope=None):
+    if not isinstance(tree, CombinedSelector):
+        xpath = translator.xpath(tree)
+        if scope is not None:
+            xpath.add_condition(scope)
+        return xpath
+    xpath = translator.xpath(tree.subselector)
+    left = _reverse_xpath(translator, tree.selector, scope)
+    return xpath.add_condition(
+        reverse_combinators[tree.combinator] % left)
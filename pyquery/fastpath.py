@@ -0,0 +1,146 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+"""Native matching of simple selectors (``tag``, ``#id``, ``.class``,
+``tag.class``, ``[attr=value]``...) without cssselect nor XPath.
+"""
+from .cssselectpatch import JQueryTranslator
+from .cache import LRUCache
+from lxml import etree
+import re
+
+try:
+    str_types = (str, unicode)
+except NameError:
+    str_types = (str,)
+
+_ident = r'[_a-zA-Z][_a-zA-Z0-9-]*'
+_name = r'[_a-zA-Z0-9-]+'
+
+SIMPLE_SELECTOR = re.compile(r'''^
+    (?P<tag>%(ident)s)?
+    (?:
+        \#(?P<id>%(name)s) |
+        \.(?P<class_>-?%(ident)s) |
+        \[(?P<attr>%(ident)s)=(?:
+            "(?P<dquoted>[^"\\\n]*)" |
+            '(?P<squoted>[^'\\\n]*)' |
+            (?P<value>-?%(ident)s))\]
+    )?
+$''' % dict(ident=_ident, name=_name), re.VERBOSE)
+
+# same as XPath's normalize-space()
+split_classes = re.compile('[ \t\r\n]+').split
+
+simple_cache = LRUCache(maxsize=1024)
+
+
+class SimpleSelector(object):
+    """A parsed simple selector. ``match(element)`` behaves like the
+    ``self::`` XPath translation and ``select(context)`` like the
+    ``descendant-or-self::`` one::
+
+        >>> from lxml import etree
+        >>> root = etree.fromstring('<a><b class="x y"/><b/></a>')
+        >>> sel = SimpleSelector(tag='b', class_='y')
+        >>> sel.select(root)  # doctest: +ELLIPSIS
+        [<Element b at ...>]
+        >>> sel.match(root)
+        False
+    """
+
+    __slots__ = ('tag', 'id', 'class_', 'attr', 'value', 'match')
+
+    def __init__(self, tag=None, id=None, class_=None, attr=None, value=None):
+        self.tag = tag
+        self.id = id
+        self.class_ = class_
+        if id is not None:
+            attr, value = 'id', id
+        self.attr = attr
+        self.value = value
+
+        if class_ is not None:
+            def check(el):
+                classes = el.get('class')
+                return (classes is not None and class_ in classes and
+                        class_ in split_classes(classes))
+        elif attr is not None:
+            def check(el):
+                return el.get(attr) == value
+        else:
+            check = None
+
+        if tag is None:
+            if check is None:
+                raise ValueError('Empty selector')
+
+            def match(el):
+                return isinstance(el.tag, str_types) and check(el)
+        elif check is None:
+            def match(el):
+                return el.tag == tag
+        else:
+            def match(el):
+                return el.tag == tag and check(el)
+        self.match = match
+
+    @property
+    def fast_select(self):
+        """True when :meth:`select` is faster than libxml2. A full tree walk
+        from python is slower than XPath when no tag or class can be used to
+        restrict it"""
+        return self.tag is not None or self.class_ is not None
+
+    def iter(self, context):
+        """Iter over matching elements, including context, in document
+        order"""
+        if self.tag is not None:
+            elements = context.iter(self.tag)
+            if self.class_ is None and self.attr is None:
+                return elements
+        else:
+            elements = context.iter(etree.Element)
+        match = self.match
+        return (el for el in elements if match(el))
+
+    def select(self, context):
+        return list(self.iter(context))
+
+    def __repr__(self):
+        return '<SimpleSelector tag=%r id=%r class=%r attr=%r value=%r>' % (
+            self.tag, self.id, self.class_, self.attr, self.value)
+
+
+def parse(selector, translator):
+    """Return a :class:`SimpleSelector` for selector or None if it's not
+    simple enough (or if translator may translate it differently than
+    :class:`~pyquery.cssselectpatch.JQueryTranslator`)"""
+    if type(translator) is not JQueryTranslator:
+        return None
+    key = (selector, translator.lower_case_element_names,
+           translator.lower_case_attribute_names)
+    simple = simple_cache.get(key)
+    if simple is None:
+        simple = False
+        match = SIMPLE_SELECTOR.match(selector.replace('[@', '['))
+        if match is not None and selector:
+            groups = match.groupdict()
+            tag = groups['tag']
+            if tag is not None and translator.lower_case_element_names:
+                tag = tag.lower()
+            attr = groups['attr']
+            if attr is not None and translator.lower_case_attribute_names:
+                attr = attr.lower()
+            value = groups['value']
+            if value is None:
+                value = groups['dquoted']
+            if value is None:
+                value = groups['squoted']
+            simple = SimpleSelector(tag=tag, id=groups['id'],
+                                    class_=groups['class_'],
+                                    attr=attr, value=value)
+        simple_cache.set(key, simple)
+    return simple or None
@@ -0,0 +1,218 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+"""Opt-in per document indexes. See
+:meth:`pyquery.pyquery.PyQuery.create_index`
+"""
+from .fastpath import split_classes
+from .fastpath import str_types
+from lxml import etree
+import bisect
+import weakref
+
+#: :class:`DocumentIndex` of each indexed document by root element. An index
+#: lives as long as the PyQuery objects using it
+indexes = weakref.WeakValueDictionary()
+
+
+def _root(el):
+    return el.getroottree().getroot()
+
+
+def find_index(elements):
+    """Return the index of the document of the first element or None"""
+    if indexes:
+        for el in elements:
+            if hasattr(el, 'getroottree'):
+                return indexes.get(_root(el))
+            break
+    return None
+
+
+def find_indexes(elements):
+    """Return the indexes of the documents of elements"""
+    found = []
+    if indexes:
+        roots = set()
+        for el in elements:
+            if not hasattr(el, 'getroottree'):
+                continue
+            root = _root(el)
+            if root not in roots:
+                roots.add(root)
+                index = indexes.get(root)
+                if index is not None:
+                    found.append(index)
+    return found
+
+
+class DocumentIndex(object):
+    """id, class, tag and attribute indexes of a document, built in one
+    tree walk::
+
+        >>> from lxml import etree
+        >>> from pyquery.fastpath import SimpleSelector
+        >>> root = etree.fromstring('<a><b class="x"/><c class="x"/></a>')
+        >>> index = DocumentIndex(root)
+        >>> [e.tag for e in index.select(SimpleSelector(class_='x'), [root])]
+        ['b', 'c']
+
+    Other attributes can be indexed by value::
+
+        >>> index = DocumentIndex(root, ['class'])
+        >>> sel = SimpleSelector(attr='class', value='x')
+        >>> [e.tag for e in index.select(sel, [root])]
+        ['b', 'c']
+
+    Entries are ``(position, element)`` pairs kept in document order. The
+    index is rebuilt lazily after a structural change and updated in place
+    when an indexed attribute changes. There is one index per document: it
+    is registered in :data:`indexes` so that every PyQuery object of the
+    document finds it with :func:`find_index`.
+    """
+
+    def __init__(self, root, attributes=()):
+        self.root = root = _root(root)
+        self.indexed_attributes = tuple(attributes)
+        self.invalidate()
+        indexes[root] = self
+
+    @property
+    def attributes(self):
+        """names of the attributes used by the indexes"""
+        return ('id', 'class') + self.indexed_attributes
+
+    def add_attributes(self, attributes):
+        """index more attributes"""
+        attributes = [a for a in attributes
+                      if a not in self.indexed_attributes]
+        if attributes:
+            self.indexed_attributes += tuple(attributes)
+            self.invalidate()
+
+    def invalidate(self):
+        """Drop the indexes. They are rebuilt on next lookup"""
+        self.positions = None
+        self.ids = self.classes = self.tags = self.values = None
+
+    def build(self):
+        root = _root(self.root)
+        if root is not self.root:
+            # e.g. the root was wrapped
+            self.root = root
+            indexes[root] = self
+        positions = {}
+        ids = {}
+        classes = {}
+        tags = {}
+        values = dict((name, {}) for name in self.indexed_attributes)
+        attributes = list(values.items())
+        starts = []
+        position = 0
+        for event, el in etree.iterwalk(root, events=('start', 'end')):
+            if event == 'end':
+                positions[el] = (starts.pop(), position - 1)
+                continue
+            starts.append(position)
+            if isinstance(el.tag, str_types):
+                entry = (position, el)
+                tags.setdefault(el.tag, []).append(entry)
+                value = el.get('id')
+                if value is not None:
+                    ids.setdefault(value, []).append(entry)
+                value = el.get('class')
+                if value:
+                    for name in set(split_classes(value)):
+                        if name:
+                            classes.setdefault(name, []).append(entry)
+                for name, mapping in attributes:
+                    value = el.get(name)
+                    if value is not None:
+                        mapping.setdefault(value, []).append(entry)
+            position += 1
+        self.ids = ids
+        self.classes = classes
+        self.tags = tags
+        self.values = values
+        self.positions = positions
+
+    def _insert(self, mapping, key, entry):
+        bisect.insort(mapping.setdefault(key, []), entry)
+
+    def _discard(self, mapping, key, entry):
+        entries = mapping.get(key)
+        if entries:
+            i = bisect.bisect_left(entries, entry[:1])
+            if i < len(entries) and entries[i][1] is entry[1]:
+                del entries[i]
+            if not entries:
+                del mapping[key]
+
+    def attribute_changed(self, el, name, old, new):
+        """update the indexes after an attribute value change"""
+        if self.positions is None or old == new:
+            return
+        if name not in self.attributes:
+            return
+        position = self.positions.get(el)
+        if position is None:
+            self.invalidate()
+            return
+        entry = (position[0], el)
+        if name in self.values:
+            mapping = self.values[name]
+            if old is not None:
+                self._discard(mapping, old, entry)
+            if new is not None:
+                self._insert(mapping, new, entry)
+        if name == 'id':
+            if old is not None:
+                self._discard(self.ids, old, entry)
+            if new is not None:
+                self._insert(self.ids, new, entry)
+        elif name == 'class':
+            old = set(split_classes(old or ''))
+            new = set(split_classes(new or ''))
+            for value in old - new:
+                if value:
+                    self._discard(self.classes, value, entry)
+            for value in new - old:
+                if value:
+                    self._insert(self.classes, value, entry)
+
+    def _candidates(self, simple):
+        if simple.id is not None:
+            return self.ids.get(simple.id, ())
+        elif simple.class_ is not None:
+            return self.classes.get(simple.class_, ())
+        elif simple.attr is None:
+            return self.tags.get(simple.tag, ())
+        elif simple.attr in self.values:
+            return self.values[simple.attr].get(simple.value, ())
+        return None
+
+    def select(self, simple, contexts):
+        """Return elements matching the
+        :class:`~pyquery.fastpath.SimpleSelector` in contexts (and their
+        descendants) or None if the index can't answer"""
+        if self.positions is None:
+            self.build()
+        candidates = self._candidates(simple)
+        if candidates is None:
+            return None
+        positions = self.positions
+        match = simple.match
+        results = []
+        for context in contexts:
+            if not isinstance(context.tag, str_types):
+                continue
+            span = positions.get(context)
+            if span is None:
+                return None
+            start, end = span
+            i = bisect.bisect_left(candidates, (start,))
+            j = bisect.bisect_left(candidates, (end + 1,))
+            results.extend(el for _, el in candidates[i:j] if match(el))
+        return results
@@ -4,20 +4,16 @@ import sys
 PY3k = sys.version_info >= (3,)
 
 if PY3k:
-    from urllib.request import urlopen
     from urllib.parse import urlencode
-    from urllib.error import HTTPError
+    from importlib.util import find_spec
     basestring = (str, bytes)
 else:
-    from urllib2 import urlopen  # NOQA
     from urllib import urlencode  # NOQA
-    from urllib2 import HTTPError
+    from pkgutil import find_loader as find_spec  # NOQA
 
-try:
-    import requests
-    HAS_REQUEST = True
-except ImportError:
-    HAS_REQUEST = False
+# requests and urllib are only imported when an url is opened: they are
+# slower to import than the rest of pyquery
+HAS_REQUEST = find_spec('requests') is not None
 
 DEFAULT_TIMEOUT = 60
 
@@ -49,6 +45,11 @@ def _query(url, method, kwargs):
 
 
 def _requests(url, kwargs):
+    import requests
+    if PY3k:
+        from urllib.error import HTTPError
+    else:
+        from urllib2 import HTTPError
 
     encoding = kwargs.get('encoding')
     method = kwargs.get('method', 'get').lower()
@@ -74,6 +75,10 @@ def _requests(url, kwargs):
 
 
 def _urllib(url, kwargs):
+    if PY3k:
+        from urllib.request import urlopen
+    else:
+        from urllib2 import urlopen
     method = kwargs.get('method')
     url, data = _query(url, method, kwargs)
     return urlopen(url, data, timeout=kwargs.get('timeout', DEFAULT_TIMEOUT))
@@ -0,0 +1,48 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+"""Configured lxml parsers reused by each thread. See
+:func:`get_parser`"""
+from lxml import etree
+import threading
+
+#: maximum number of option sets kept by each thread
+maxsize = 16
+
+_local = threading.local()
+
+
+def get_parser(name, options):
+    """Return the ``'xml'`` or ``'html'`` parser configured with the
+    options dict. Parsers are created once per thread and per options (lxml
+    parsers can't be used by two threads at a time)::
+
+        >>> parser = get_parser('xml', {'remove_comments': True})
+        >>> parser is get_parser('xml', {'remove_comments': True})
+        True
+        >>> len(etree.fromstring('<a><!-- c --></a>', parser))
+        0
+
+    Options are the keyword arguments of ``lxml.etree.XMLParser`` and
+    ``lxml.html.HTMLParser``. Their values must be hashable.
+    """
+    try:
+        parsers = _local.parsers
+    except AttributeError:
+        parsers = _local.parsers = {}
+    key = (name, tuple(sorted(options.items())))
+    parser = parsers.get(key)
+    if parser is None:
+        if len(parsers) >= maxsize:
+            parsers.clear()
+        if name == 'xml':
+            parser = etree.XMLParser(**options)
+        elif name == 'html':
+            import lxml.html
+            parser = lxml.html.HTMLParser(**options)
+        else:
+            raise ValueError('No options for the "%s" parser' % name)
+        parsers[key] = parser
+    return parser
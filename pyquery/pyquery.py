@@ -4,15 +4,34 @@
 #
 # Distributed under the BSD license, see LICENSE.txt
 from .cssselectpatch import JQueryTranslator
+from .cssselectpatch import self_xpath
+from .cache import CachedDocument
+from .cache import css_cache
+from .cache import document_cache
+from .cache import document_key
+from .cache import estimated_size
+from .cache import fragment_cache
+from .cache import fragment_key
+from .cache import xpath_cache
+from .index import DocumentIndex
+from .index import find_index
+from .index import find_indexes
 from collections import OrderedDict
 from .openers import url_opener
+from .parsers import get_parser
+from .sniff import min_size
+from .sniff import sniff_parser
+from . import cache
+from . import fastpath
 from .text import extract_text
 from copy import deepcopy
+from itertools import islice
 from lxml import etree
-import lxml.html
 import inspect
+import threading
 import types
 import sys
+import re
 
 
 PY3k = sys.version_info >= (3,)
@@ -29,11 +48,6 @@ if PY3k:
     string_types = (str,)
     text_type = str
 
-    def getargspec(func):
-        args = inspect.signature(func).parameters.values()
-        return [p.name for p in args
-                if p.kind == p.POSITIONAL_OR_KEYWORD]
-
     def getdefaultsspec(func):
         return func.__defaults__
 
@@ -48,9 +62,6 @@ else:
     string_types = (unicode, str)
     text_type = unicode
 
-    def getargspec(func):
-        return list(inspect.getargspec(func).args)
-
     def getdefaultsspec(func):
         return inspect.getargspec(func).defaults
 
@@ -83,28 +94,89 @@ def build_camel_case_aliases(PyQuery):
         setattr(PyQuery, name, f.__get__(None, PyQuery))
 
 
-def fromstring(context, parser=None, custom_parser=None):
+def fromstring(context, parser=None, custom_parser=None,
+               parser_options=None):
     """use html parser if we don't have clean xml
     """
+    return _fromstring(context, parser, custom_parser, parser_options)[0]
+
+
+def _parser_kwargs(name, parser_options):
+    """keyword arguments of lxml parse functions for parser_options"""
+    if parser_options is None:
+        return {}
+    if name == 'html_fragments':
+        name = 'html'
+    return {'parser': get_parser(name, parser_options)}
+
+
+def _fromstring(context, parser=None, custom_parser=None,
+                parser_options=None):
+    """return the elements of context and the name of the parser used.
+    Strings may be found in :data:`~pyquery.cache.fragment_cache` or
+    :data:`~pyquery.cache.document_cache`"""
+    if custom_parser is not None or not isinstance(context, basestring):
+        return _parse(context, parser, custom_parser, parser_options)
+    if fragment_cache.maxsize and len(context) <= cache.fragment_max_length:
+        entries = fragment_cache
+        key = fragment_key(context, parser, parser_options)
+    elif document_cache.maxsize and parser != 'xml':
+        entries = document_cache
+        key = document_key(context, parser, parser_options)
+    else:
+        return _parse(context, parser, custom_parser, parser_options)
+    cached = entries.get(key)
+    if cached is None:
+        elements, parser = _parse(context, parser, None, parser_options)
+        if parser == 'xml' and entries is document_cache:
+            return elements, parser
+        try:
+            cached = CachedDocument(elements, parser, estimated_size(context))
+        except ValueError:
+            return elements, parser
+        entries.set(key, cached)
+    # copy on miss too: callers may modify the elements
+    return cached.copy(), cached.parser
+
+
+def _parse(context, parser=None, custom_parser=None, parser_options=None):
     if hasattr(context, 'read') and hasattr(context.read, '__call__'):
         meth = 'parse'
     else:
         meth = 'fromstring'
+    kwargs = {}
     if custom_parser is None:
         if parser is None:
-            try:
-                result = getattr(etree, meth)(context)
-            except etree.XMLSyntaxError:
-                if hasattr(context, 'seek'):
-                    context.seek(0)
-                result = getattr(lxml.html, meth)(context)
+            if (not isinstance(context, basestring) or
+                    len(context) >= min_size):
+                parser = sniff_parser(context)
+            if parser is None:
+                try:
+                    kwargs = _parser_kwargs('xml', parser_options)
+                except TypeError:
+                    # options of the html parser only
+                    parser = 'html'
+            if parser is None:
+                try:
+                    result = getattr(etree, meth)(context, **kwargs)
+                    parser = 'xml'
+                except etree.XMLSyntaxError:
+                    if hasattr(context, 'seek'):
+                        context.seek(0)
+                    parser = 'html'
+            if parser == 'html':
+                import lxml.html
+                result = getattr(lxml.html, meth)(
+                    context, **_parser_kwargs('html', parser_options))
             if isinstance(result, etree._ElementTree):
-                return [result.getroot()]
+                return [result.getroot()], parser
             else:
-                return [result]
-        elif parser == 'xml':
+                return [result], parser
+        kwargs = _parser_kwargs(parser, parser_options)
+        if parser == 'xml':
             custom_parser = getattr(etree, meth)
         elif parser == 'html':
+            import lxml.html
             custom_parser = getattr(lxml.html, meth)
         elif parser == 'html5':
             from lxml.html import html5parser
@@ -113,23 +185,261 @@ def fromstring(context, parser=None, custom_parser=None):
             from lxml.html import soupparser
             custom_parser = getattr(soupparser, meth)
         elif parser == 'html_fragments':
+            import lxml.html
             custom_parser = lxml.html.fragments_fromstring
         else:
             raise ValueError('No such parser: "%s"' % parser)
 
-    result = custom_parser(context)
+    result = custom_parser(context, **kwargs)
     if type(result) is list:
-        return result
+        return result, parser
     elif isinstance(result, etree._ElementTree):
-        return [result.getroot()]
+        return [result.getroot()], parser
     elif result is not None:
-        return [result]
+        return [result], parser
     else:
-        return []
+        return [], parser
+
+
+def _copies(root, count):
+    """yield the children of root (an element or a list of elements) for
+    each of count targets: copies first, the children themselves last.
+    Copying parsed nodes is much cheaper than parsing them again"""
+    children = list(root)
+    for _ in range(count - 1):
+        if isinstance(root, etree._Element):
+            # one copy of the tree instead of one per child
+            yield list(deepcopy(root))
+        else:
+            yield [deepcopy(child) for child in children]
+    if count:
+        yield children
 
 
-def callback(func, *args):
-    return func(*args[:func_code(func).co_argcount])
+#: :func:`css_to_xpath` prefix of an xpath testing the context node like
+#: ``self::``. The leftmost part of combined selectors must also be in the
+#: element given as the ``scope`` variable of the evaluation
+scoped_self = 'scoped-self::'
+
+_in_scope = 'ancestor-or-self::*[count(. | $scope) = 1]'
+
+
+def css_to_xpath(translator, selector, prefix='descendant-or-self::'):
+    """return the (cached) xpath translation of a css selector"""
+    key = (translator.__class__, getattr(translator, 'xhtml', None),
+           selector, prefix)
+    xpath = css_cache.get(key)
+    if xpath is None:
+        selector = selector.replace('[@', '[')
+        if prefix == 'self::':
+            xpath = self_xpath(translator, selector)
+        elif prefix == scoped_self:
+            xpath = self_xpath(translator, selector, _in_scope)
+        else:
+            xpath = translator.css_to_xpath(selector, prefix)
+        css_cache.set(key, xpath)
+    return xpath
+
+
+def compiled_xpath(expr, namespaces=None, smart_strings=True):
+    """return a cached ``etree.XPath`` evaluator for expr"""
+    key = (expr, frozenset(namespaces.items()) if namespaces else None,
+           smart_strings)
+    evaluator = xpath_cache.get(key)
+    if evaluator is None:
+        evaluator = etree.XPath(expr, namespaces=namespaces,
+                                smart_strings=smart_strings)
+        xpath_cache.set(key, evaluator)
+    return evaluator
+
+
+def is_context_free(xpath, prefix='descendant-or-self::'):
+    """True if xpath is a single location step whose predicates don't depend
+    on the context node nor on the position of the node in the node-set. The
+    results of such an xpath evaluated on an ancestor are the results of
+    each descendant evaluation"""
+    depth = 0
+    quote = None
+    for i, char in enumerate(xpath):
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif depth == 0:
+            if char == '/':
+                return False
+            elif (char == '|' and
+                  not xpath[i + 1:].lstrip().startswith(prefix)):
+                return False
+    return 'position()' not in xpath and 'last()' not in xpath
+
+
+def unique_elements(elements):
+    """remove duplicates from elements. Keep the first occurrence"""
+    seen = set()
+    add = seen.add
+    return [e for e in elements if not (e in seen or add(e))]
+
+
+def document_order(elements):
+    """sort unique elements in document order. Each node is keyed by the
+    path of its indexes from the root"""
+    if len(elements) < 2:
+        return list(elements)
+    keys = {}
+    indexes = {}
+    roots = {}
+    for el in elements:
+        path = []
+        node = el
+        while node not in keys:
+            parent = node.getparent()
+            if parent is None:
+                keys[node] = (roots.setdefault(node, len(roots)),)
+                break
+            path.append((node, parent))
+            node = parent
+        for node, parent in reversed(path):
+            positions = indexes.get(parent)
+            if positions is None:
+                positions = indexes[parent] = dict(
+                    (child, i) for i, child in enumerate(parent))
+            keys[node] = keys[parent] + (positions[node],)
+    return sorted(elements, key=keys.__getitem__)
+
+
+def outermost(elements):
+    """keep elements which are not descendants of another one"""
+    elements = unique_elements(
+        e for e in elements if isinstance(e.tag, basestring))
+    if len(elements) < 2:
+        return elements
+    contexts = set(elements)
+    return [e for e in elements
+            if not any(a in contexts for a in e.iterancestors())]
+
+
+def topmost(element):
+    """return the outermost ancestor of element, or element itself. Unlike
+    the document root, it contains elements detached from the document"""
+    parent = element.getparent()
+    while parent is not None:
+        element, parent = parent, parent.getparent()
+    return element
+
+
+# a single location step selecting elements by name. Elements can be
+# walked with iter(name) and tested one by one
+_single_tag = re.compile(r'^descendant-or-self::([a-zA-Z_][\w.-]*)(?:\[|$)')
+_self_tag = re.compile(r'^self::([a-zA-Z_][\w.-]*)(?:\[|$)')
+
+
+def common_ancestor(first, last):
+    """return the nearest element containing first and last, or None"""
+    ancestors = set(first.iterancestors())
+    ancestors.add(first)
+    while last is not None and last not in ancestors:
+        last = last.getparent()
+    return last
+
+
+def filter_descendants(elements, contexts, top, strict=False):
+    """keep elements which are contexts or descendants of one of them (only
+    descendants if strict is true). All elements must be in top"""
+    state = dict.fromkeys(contexts, True)
+    state.setdefault(top, False)
+    results = []
+    for el in elements:
+        path = []
+        node = el.getparent() if strict else el
+        while node is not None and node not in state:
+            path.append(node)
+            node = node.getparent()
+            if node is None:
+                break
+        value = state.get(node, False)
+        for node in path:
+            state[node] = value
+        if value:
+            results.append(el)
+    return results
+
+
+#: locks of the module globals where callbacks find ``this``, by id
+_locks = {}
+
+
+def _globals_lock(namespace):
+    lock = _locks.get(id(namespace))
+    if lock is None:
+        lock = _locks.setdefault(id(namespace), threading.RLock())
+    return lock
+
+
+class Callback(object):
+    """Call func with the arguments it accepts and ``this`` bound to the
+    current element. func is only inspected once.
+
+    ``this`` is a global of the module of func while func runs. The previous
+    value is restored after each call, under a lock of the module: callbacks
+    of a module run one at a time, even from many threads, so they must not
+    wait for each other.
+    """
+
+    def __init__(self, func, trim=True):
+        self.nargs = None
+        self.namespace = None
+        function = getattr(func, '__func__', func)
+        instance = getattr(func, '__self__', None)
+        if isinstance(function, types.FunctionType):
+            code = func_code(function)
+            if trim and not code.co_flags & inspect.CO_VARARGS:
+                self.nargs = code.co_argcount
+                if function is not func and instance is not None:
+                    self.nargs -= 1
+            self.namespace = func_globals(function)
+            self.lock = _globals_lock(self.namespace)
+        self.func = func
+
+    def call(self, value, args, kwargs):
+        """return func(*args, **kwargs) with ``this`` bound to value"""
+        namespace = self.namespace
+        if namespace is None:
+            return self.func(*args, **kwargs)
+        with self.lock:
+            old = namespace.get('this', no_default)
+            namespace['this'] = value
+            try:
+                return self.func(*args, **kwargs)
+            finally:
+                if old is no_default:
+                    namespace.pop('this', None)
+                else:
+                    namespace['this'] = old
+
+    def __call__(self, value, *args, **kwargs):
+        if self.nargs is not None:
+            args = args[:self.nargs]
+        return self.call(value, args, kwargs)
+
+    def results(self, elements):
+        """yield func(index, element) for each element, with ``this`` bound
+        to element"""
+        nargs = self.nargs
+        call = self.call
+        kwargs = {}
+        for i, element in enumerate(elements):
+            if nargs is None or nargs >= 2:
+                yield call(element, (i, element), kwargs)
+            elif nargs == 1:
+                yield call(element, (i,), kwargs)
+            else:
+                yield call(element, (), kwargs)
 
 
 class NoDefault(object):
@@ -142,6 +452,31 @@ no_default = NoDefault()
 del NoDefault
 
 
+class FlexibleProperty(object):
+    """real element to support set/get/del attr and item and js call
+    style. Bound to one instance by :class:`FlexibleElement`"""
+
+    __slots__ = ('__element', '__instance')
+
+    def __init__(prop, element, instance):
+        object.__setattr__(prop, '_FlexibleProperty__element', element)
+        object.__setattr__(prop, '_FlexibleProperty__instance', instance)
+
+    def __call__(prop, *args, **kwargs):
+        return prop.__element.pget(prop.__instance, *args, **kwargs)
+    __getattr__ = __getitem__ = __setattr__ = __setitem__ = __call__
+
+    def __delitem__(prop, name):
+        if prop.__element.pdel is not no_default:
+            return prop.__element.pdel(prop.__instance, name)
+        else:
+            raise NotImplementedError()
+    __delattr__ = __delitem__
+
+    def __repr__(prop):
+        return '<flexible_element %s>' % prop.__element.pget.__name__
+
+
 class FlexibleElement(object):
     """property to allow a flexible api"""
     def __init__(self, pget, pset=no_default, pdel=no_default):
@@ -150,23 +485,7 @@ class FlexibleElement(object):
         self.pdel = pdel
 
     def __get__(self, instance, klass):
-        class _element(object):
-            """real element to support set/get/del attr and item and js call
-            style"""
-            def __call__(prop, *args, **kwargs):
-                return self.pget(instance, *args, **kwargs)
-            __getattr__ = __getitem__ = __setattr__ = __setitem__ = __call__
-
-            def __delitem__(prop, name):
-                if self.pdel is not no_default:
-                    return self.pdel(instance, name)
-                else:
-                    raise NotImplementedError()
-            __delattr__ = __delitem__
-
-            def __repr__(prop):
-                return '<flexible_element %s>' % self.pget.__name__
-        return _element()
+        return FlexibleProperty(self, instance)
 
     def __set__(self, instance, value):
         if self.pset is not no_default:
@@ -175,17 +494,117 @@ class FlexibleElement(object):
             raise NotImplementedError()
 
 
+class Selector(object):
+    """A css selector translated and compiled once. Use
+    :meth:`PyQuery.compile` or :func:`pyquery.compile` to get one.
+
+    Selectors are immutable and can be pickled::
+
+        >>> import pickle
+        >>> sel = Selector('p > b', namespaces={'bar': 'http://bar'})
+        >>> sel
+        <Selector 'p > b'>
+        >>> pickle.loads(pickle.dumps(sel)).xpath
+        'descendant-or-self::p/b'
+    """
+
+    __slots__ = ('selector', 'namespaces', 'xhtml', 'translator_class',
+                 'xpath', 'self_xpath', '_evaluators', '_translator')
+
+    def __init__(self, selector, namespaces=None, xhtml=False,
+                 translator_class=JQueryTranslator):
+        if namespaces is not None:
+            namespaces = dict(namespaces)
+        translator = translator_class(xhtml=xhtml)
+        xpath = css_to_xpath(translator, selector)
+        self_xpath = css_to_xpath(translator, selector, 'self::')
+        evaluators = {
+            'descendant-or-self::': compiled_xpath(xpath, namespaces),
+            'self::': compiled_xpath(self_xpath, namespaces),
+        }
+        for name, value in (('selector', selector),
+                            ('namespaces', namespaces),
+                            ('xhtml', xhtml),
+                            ('translator_class', translator_class),
+                            ('xpath', xpath),
+                            ('self_xpath', self_xpath),
+                            ('_evaluators', evaluators),
+                            ('_translator', translator)):
+            object.__setattr__(self, name, value)
+
+    def css_to_xpath(self, prefix='descendant-or-self::'):
+        """return the xpath translation using prefix"""
+        return css_to_xpath(self._translator, self.selector, prefix)
+
+    def evaluator(self, prefix='descendant-or-self::', namespaces=None):
+        """return a compiled ``etree.XPath``. namespaces are only used if
+        the selector was compiled without namespaces"""
+        if self.namespaces is None and namespaces:
+            return compiled_xpath(self.css_to_xpath(prefix), namespaces)
+        evaluator = self._evaluators.get(prefix)
+        if evaluator is None:
+            evaluator = compiled_xpath(self.css_to_xpath(prefix),
+                                       self.namespaces)
+        return evaluator
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Selector objects are immutable')
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (self.__class__, (self.selector, self.namespaces,
+                                 self.xhtml, self.translator_class))
+
+    def __eq__(self, other):
+        return (isinstance(other, Selector) and
+                self.__reduce__() == other.__reduce__())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.selector, self.xhtml, self.translator_class))
+
+    def __repr__(self):
+        return '<Selector %r>' % self.selector
+
+
 class PyQuery(list):
     """The main class
     """
 
     _translator_class = JQueryTranslator
 
+    #: answer simple selectors (``tag``, ``#id``, ``.class``, ``tag.class``,
+    #: ``[attr=value]``) natively instead of using cssselect and XPath
+    _fast_path = True
+
+    #: minimum number of context elements to evaluate a selection once for
+    #: the whole set of contexts instead of once per context
+    _set_evaluation_threshold = 16
+
+    #: maximum number of nodes per tested element of the trees where a
+    #: matcher evaluates its selector once. Testing an element alone costs
+    #: about as much as evaluating a selector over 8 nodes
+    _set_evaluation_ratio = 8
+
+    #: name of the parser used when the document was parsed by this object:
+    #: ``'xml'`` or ``'html'`` if none was given. See
+    #: :func:`~pyquery.sniff.sniff_parser`
+    document_parser = None
+
+    #: options of the lxml parser, e.g. ``{'remove_blank_text': True}``.
+    #: See :func:`~pyquery.parsers.get_parser`
+    parser_options = None
+
+    _index = None
+
     def __init__(self, *args, **kwargs):
         html = None
         elements = []
         self._base_url = None
         self.parser = kwargs.pop('parser', None)
+        self.parser_options = kwargs.pop('parser_options', None)
 
         if (len(args) >= 1 and
                 isinstance(args[0], string_types) and
@@ -210,6 +629,7 @@ class PyQuery(list):
             self._translator = self._translator_class(xhtml=False)
 
         self.namespaces = kwargs.pop('namespaces', None)
+        limit = kwargs.pop('limit', None)
 
         if kwargs:
             # specific case to get the dom
@@ -228,7 +648,8 @@ class PyQuery(list):
             else:
                 raise ValueError('Invalid keyword arguments %s' % kwargs)
 
-            elements = fromstring(html, self.parser)
+            elements, self.document_parser = _fromstring(
+                html, self.parser, parser_options=self.parser_options)
             # close open descriptor if possible
             if hasattr(html, 'close'):
                 try:
@@ -252,10 +673,9 @@ class PyQuery(list):
 
             # get context
             if isinstance(context, basestring):
-                try:
-                    elements = fromstring(context, self.parser)
-                except Exception:
-                    raise
+                elements, self.document_parser = _fromstring(
+                    context, self.parser,
+                    parser_options=self.parser_options)
             elif isinstance(context, self.__class__):
                 # copy
                 elements = context[:]
@@ -266,25 +686,264 @@ class PyQuery(list):
             else:
                 raise TypeError(context)
 
+            self._index = find_index(elements)
+
             # select nodes
             if elements and selector is not no_default:
-                xpath = self._css_to_xpath(selector)
-                results = []
-                for tag in elements:
-                    results.extend(
-                        tag.xpath(xpath, namespaces=self.namespaces))
-                elements = results
+                elements = self._select(selector, elements, limit=limit)
 
         list.__init__(self, elements)
 
     def _css_to_xpath(self, selector, prefix='descendant-or-self::'):
-        selector = selector.replace('[@', '[')
-        return self._translator.css_to_xpath(selector, prefix)
+        if isinstance(selector, Selector):
+            return selector.css_to_xpath(prefix)
+        return css_to_xpath(self._translator, selector, prefix)
+
+    def _compiled_xpath(self, selector, prefix='descendant-or-self::'):
+        if isinstance(selector, Selector):
+            return selector.evaluator(prefix, self.namespaces)
+        return compiled_xpath(self._css_to_xpath(selector, prefix),
+                              self.namespaces)
+
+    def _wrapped_xpath(self, selector, template):
+        """return a compiled XPath of the translation of selector wrapped in
+        template (e.g. ``'count(%s)'``)"""
+        namespaces = self.namespaces
+        if isinstance(selector, Selector) and selector.namespaces is not None:
+            namespaces = selector.namespaces
+        return compiled_xpath(template % self._css_to_xpath(selector),
+                              namespaces)
+
+    def _simple_selector(self, selector):
+        if not self._fast_path:
+            return None
+        if isinstance(selector, Selector):
+            return fastpath.parse(selector.selector, selector._translator)
+        return fastpath.parse(selector, self._translator)
+
+    def _select(self, selector, elements, strict=False, limit=None):
+        """return elements matching selector in elements and their
+        descendants (only their descendants if strict is true). Stop after
+        limit elements in document order if limit is not None"""
+        if limit is not None:
+            if strict:
+                elements = [child for tag in elements
+                            for child in tag.getchildren()]
+            return self._select_first(selector, elements, limit)
+        results = None
+        simple = self._simple_selector(selector)
+        if len(elements) >= self._set_evaluation_threshold:
+            results = self._select_in_set(selector, simple, elements, strict)
+            if results is not None:
+                return results
+        if len(elements) > 1:
+            # the results of contexts in document order are in document
+            # order, as the ones of _select_in_set
+            elements = document_order(elements)
+        if strict:
+            elements = [child for tag in elements
+                        for child in tag.getchildren()]
+        if simple is not None and self._index is not None:
+            results = self._index.select(simple, elements)
+        if results is None:
+            results = []
+            if simple is not None and simple.fast_select:
+                for tag in elements:
+                    results.extend(simple.iter(tag))
+            else:
+                xpath = self._compiled_xpath(selector)
+                for tag in elements:
+                    if isinstance(tag.tag, basestring):
+                        results.extend(xpath(tag))
+        if len(elements) > 1:
+            results = unique_elements(results)
+        return results
+
+    def _select_first(self, selector, elements, limit):
+        """return the first limit elements matching selector in elements
+        and their descendants, in document order. Each context is only
+        evaluated until limit elements are found"""
+        if limit <= 0:
+            return []
+        xpath = None
+        if self._simple_selector(selector) is None:
+            xpath = self._css_to_xpath(selector)
+            if is_context_free(xpath):
+                xpath = None
+        if xpath is not None:
+            # can't be evaluated lazily. Let libxml2 drop other elements
+            evaluate = self._wrapped_xpath(
+                selector, '(%%s)[position() <= %d]' % limit)
+            results = []
+            for context in elements:
+                if isinstance(context.tag, basestring):
+                    results.extend(evaluate(context))
+        elif len(elements) == 1:
+            return list(islice(self._iter(selector, elements), limit))
+        else:
+            results = []
+            for context in elements:
+                results.extend(islice(self._iter(selector, [context]), limit))
+        # the first elements of the selection are among the first elements
+        # found in each context
+        return document_order(unique_elements(results))[:limit]
+
+    def _select_in_set(self, selector, simple, elements, strict=False):
+        """Evaluate selector once from the nearest common ancestor of
+        elements then keep results found in elements. Return None if this
+        can't be done for this selector"""
+        if simple is None:
+            if not is_context_free(self._css_to_xpath(selector)):
+                return None
+        elif self._index is not None:
+            return None
+        contexts = [e for e in elements if isinstance(e.tag, basestring)]
+        if not contexts:
+            return []
+        top = common_ancestor(contexts[0], contexts[-1])
+        if top is None:
+            return None
+        # make sure that all contexts are in top
+        inside = set([top])
+        for context in contexts:
+            node = context.getparent()
+            if node in inside or context is top:
+                continue
+            path = []
+            while node not in inside:
+                if node is None:
+                    return None
+                path.append(node)
+                node = node.getparent()
+            inside.update(path)
+        if simple is not None and simple.fast_select:
+            results = simple.select(top)
+        else:
+            results = self._compiled_xpath(selector)(top)
+        return filter_descendants(results, contexts, top, strict)
+
+    def _selected_tag(self, selector):
+        """return the tag name of all the elements matching selector or None
+        if it is unknown"""
+        simple = self._simple_selector(selector)
+        if simple is not None:
+            return simple.tag
+        xpath = self._css_to_xpath(selector, 'self::')
+        name = _self_tag.match(xpath) if '|' not in xpath else None
+        return name.group(1) if name is not None else None
+
+    def _match(self, selector, elements):
+        """return elements matching selector"""
+        simple = self._simple_selector(selector)
+        if simple is not None:
+            match = simple.match
+            return [tag for tag in elements if match(tag)]
+        xpath = self._compiled_xpath(selector, 'self::')
+        results = []
+        for tag in elements:
+            if isinstance(tag.tag, basestring):
+                results.extend(xpath(tag))
+        return results
+
+    def _matcher(self, selector, elements=()):
+        """return a predicate telling if an element matches selector. The
+        selector is only translated once. When many elements (or their
+        ancestors) will be tested, the selector may be evaluated once per
+        tree instead, if the trees are not much larger than elements"""
+        if selector is None:
+            return lambda tag: True
+        simple = self._simple_selector(selector)
+        if simple is not None:
+            return simple.match
+        if (len(elements) >= self._set_evaluation_threshold and
+                is_context_free(self._css_to_xpath(selector))):
+            roots = set(topmost(e) for e in elements)
+            budget = len(elements) * self._set_evaluation_ratio
+            size = 0
+            for root in roots:
+                # stop counting nodes once over budget
+                size += len(list(islice(root.iter(), budget - size + 1)))
+                if size > budget:
+                    break
+            if size <= budget:
+                xpath = self._compiled_xpath(selector)
+                matched = set()
+                for root in roots:
+                    matched.update(xpath(root))
+                return matched.__contains__
+        xpath = self._compiled_xpath(selector, 'self::')
+
+        def match(tag):
+            return isinstance(tag.tag, basestring) and bool(xpath(tag))
+        return match
+
+    @classmethod
+    def compile(cls, selector, namespaces=None, xhtml=False):
+        """Return a precompiled :class:`Selector`. It can be used anywhere
+        a css selector string is accepted::
+
+            >>> spans = PyQuery.compile('span.hello')
+            >>> d = PyQuery('<div><span class="hello">Hi</span></div>')
+            >>> d(spans)
+            [<span.hello>]
+            >>> d.find(spans).text()
+            'Hi'
+        """
+        return Selector(selector, namespaces=namespaces, xhtml=xhtml,
+                        translator_class=cls._translator_class)
+
+    @classmethod
+    def feed_parser(cls, parser='html', namespaces=None, **kwargs):
+        """Return a parser for a document arriving in chunks. Parsing
+        starts with the first chunk instead of after the last one::
+
+            >>> links = []
+            >>> parser = PyQuery.feed_parser().on(
+            ...     'a', lambda a: links.append(a.attr('href')))
+            >>> parser.feed(b'<div><a href="/1">1</a><a hr')
+            >>> links
+            ['/1']
+            >>> parser.feed(b'ef="/2">2</a></div>')
+            >>> d = parser.close()
+            >>> links
+            ['/1', '/2']
+            >>> d
+            [<html>]
+            >>> d('a')
+            [<a>, <a>]
+
+        Callbacks get each element matching their selector as soon as it is
+        completely parsed. ``close()`` returns the root of the document
+        (``<html>`` for html fragments too). Other
+        keyword arguments are passed to lxml's ``XMLPullParser`` or
+        ``HTMLPullParser`` (e.g. ``encoding``).
+        """
+        from .streaming import FeedParser
+        return FeedParser(parser, namespaces=namespaces, cls=cls, **kwargs)
 
     def _copy(self, *args, **kwargs):
         kwargs.setdefault('namespaces', self.namespaces)
+        kwargs.setdefault('parser_options', self.parser_options)
         return self.__class__(*args, **kwargs)
 
+    def _derive(self, elements):
+        """Same as ``self._copy(elements, parent=self)`` for a list of
+        elements but without the argument parsing of ``__init__``"""
+        cls = self.__class__
+        if cls.__init__ is not PyQuery.__init__:
+            # subclasses may need their own initialization
+            return self._copy(list(elements), parent=self)
+        result = list.__new__(cls)
+        list.__init__(result, elements)
+        result._base_url = None
+        result.parser = None
+        result.parser_options = self.parser_options
+        result._parent = self
+        result._index = find_index(result)
+        result._translator = self._translator
+        result.namespaces = self.namespaces
+        return result
+
     def __call__(self, *args, **kwargs):
         """return a new PyQuery instance
         """
@@ -294,8 +953,15 @@ class PyQuery(list):
         if args[0] == '':
             return self._copy([])
         if (len(args) == 1 and
-                isinstance(args[0], string_types) and
-                not args[0].startswith('<')):
+                (isinstance(args[0], Selector) or
+                 isinstance(args[0], string_types) and
+                 not args[0].startswith('<'))):
+            if ((not kwargs or list(kwargs) == ['limit']) and
+                    (isinstance(args[0], Selector) or
+                     args[0].split('://', 1)[0] not in ('http', 'https'))):
+                # a selection of self. No need to parse arguments again
+                return self._derive(
+                    self._select(args[0], self, limit=kwargs.get('limit')))
             args += (self,)
         result = self._copy(*args, parent=self, **kwargs)
         return result
@@ -315,7 +981,7 @@ class PyQuery(list):
         self._extend(other[:])
         return self
 
-    def items(self, selector=None):
+    def items(self, selector=None, lazy=False):
         """Iter over elements. Return PyQuery objects:
 
             >>> d = PyQuery('<div><span>foo</span><span>bar</span></div>')
@@ -325,13 +991,115 @@ class PyQuery(list):
             ['foo', 'bar']
             >>> list(d.items('a')) == list(d('a').items())
             True
+
+        With ``lazy=True`` the selection is not built first. See
+        :meth:`iter`.
         """
-        if selector:
+        if lazy:
+            elems = self.iter(selector or None)
+        elif selector:
             elems = self(selector) or []
         else:
             elems = self
         for elem in elems:
-            yield self._copy(elem, parent=self)
+            yield self._derive([elem])
+
+    def iter(self, selector=None):
+        """Lazily iter over elements matching selector in self and their
+        descendants. Unlike ``self(selector)`` the result is not stored:
+        memory stays flat and the first element is found as soon as
+        possible:
+
+            >>> d = PyQuery('<div><span>foo</span><span>bar</span></div>')
+            >>> [e.text for e in d.iter('span')]
+            ['foo', 'bar']
+
+        Elements are yielded context by context and in document order for
+        each context. Elements are only yielded once. Positional selectors
+        (``:first``, ``:eq()``...) and selectors with sibling combinators
+        (``+``, ``~``) are still evaluated at once for each context. The
+        document should not be modified while iterating.
+        """
+        if selector is None:
+            return (tag for tag in self)
+        return self._iter(selector, self)
+
+    def _iter(self, selector, elements):
+        """lazily iter over elements matching selector in elements and their
+        descendants. See :meth:`iter`"""
+        simple = self._simple_selector(selector)
+        xpath = None if simple is not None else self._css_to_xpath(selector)
+        if xpath is not None and not is_context_free(xpath):
+            for tag in self._iter_combined(selector, xpath, elements):
+                yield tag
+            return
+        contexts = outermost(elements)
+        if simple is not None:
+            if self._index is not None:
+                results = self._index.select(simple, contexts)
+                if results is not None:
+                    for tag in results:
+                        yield tag
+                    return
+            for context in contexts:
+                for tag in simple.iter(context):
+                    yield tag
+            return
+        match = self._matcher(selector)
+        name = _single_tag.match(xpath) if '|' not in xpath else None
+        name = name.group(1) if name is not None else etree.Element
+        for context in contexts:
+            for tag in context.iter(name):
+                if match(tag):
+                    yield tag
+
+    def _iter_combined(self, selector, xpath, elements):
+        """lazily iter over elements matching a combined or positional
+        selector (xpath is its translation). Elements of each context are
+        walked and tested with an xpath of the rightmost part of the
+        selector, whose leftmost part must be in the context"""
+        if ('position()' in xpath or 'last()' in xpath or
+                'following-sibling::' in xpath):
+            match = None
+        else:
+            match = self._compiled_xpath(selector, 'self::')
+            scoped = self._compiled_xpath(selector, scoped_self)
+            if not is_context_free(scoped.path, 'self::'):
+                # e.g. pseudo elements
+                match = None
+        if match is None:
+            # positional selectors need the whole result of each context.
+            # Sibling combinators may select elements out of the context
+            evaluate = self._compiled_xpath(selector)
+            seen = set()
+            for context in elements:
+                if isinstance(context.tag, basestring):
+                    for tag in evaluate(context):
+                        if tag not in seen:
+                            seen.add(tag)
+                            yield tag
+            return
+        name = _self_tag.match(scoped.path) if '|' not in scoped.path else None
+        name = name.group(1) if name is not None else etree.Element
+        for context in outermost(elements):
+            if context.getparent() is None:
+                # the whole tree is in the scope
+                for tag in context.iter(name):
+                    if match(tag):
+                        yield tag
+            else:
+                for tag in context.iter(name):
+                    if scoped(tag, scope=context):
+                        yield tag
+
+    def iteritems(self, selector=None):
+        """Like :meth:`iter` but yield PyQuery objects:
+
+            >>> d = PyQuery('<div><span>foo</span><span>bar</span></div>')
+            >>> [i.text() for i in d.iteritems('span')]
+            ['foo', 'bar']
+        """
+        return self.items(selector, lazy=True)
 
     def xhtml_to_html(self):
         """Remove xhtml namespace:
@@ -348,7 +1116,9 @@ class PyQuery(list):
         except IndexError:
             pass
         else:
+            import lxml.html
             lxml.html.xhtml_to_html(root)
+            self.invalidate_index()
         return self
 
     def remove_namespaces(self):
@@ -368,6 +1138,7 @@ class PyQuery(list):
             for el in root.iter('{*}*'):
                 if el.tag.startswith('{'):
                     el.tag = el.tag.split('}', 1)[1]
+            self.invalidate_index()
         return self
 
     def __str__(self):
@@ -396,6 +1167,7 @@ class PyQuery(list):
             <script><![[CDATA[ ]></script>
 
         """
+        import lxml.html
         return u''.join([lxml.html.tostring(e, encoding=text_type)
                          for e in self])
 
@@ -442,24 +1214,18 @@ class PyQuery(list):
 
     def _filter_only(self, selector, elements, reverse=False, unique=False):
         """Filters the selection set only, as opposed to also including
-           descendants.
+           descendants. If unique is true, duplicates are removed and
+           elements are sorted in document order.
         """
+        if unique:
+            elements = document_order(unique_elements(elements))
         if selector is None:
             results = elements
         else:
-            xpath = self._css_to_xpath(selector, 'self::')
-            results = []
-            for tag in elements:
-                results.extend(tag.xpath(xpath, namespaces=self.namespaces))
+            results = self._match(selector, elements)
         if reverse:
             results.reverse()
-        if unique:
-            result_list = results
-            results = []
-            for item in result_list:
-                if item not in results:
-                    results.append(item)
-        return self._copy(results, parent=self)
+        return self._derive(results)
 
     def parent(self, selector=None):
         return self._filter_only(
@@ -477,26 +1243,44 @@ class PyQuery(list):
             selector,
             [e.getnext() for e in self if e.getnext() is not None])
 
-    def _traverse(self, method):
+    def _siblings(self, before=True, after=True):
+        """return unique siblings of elements in document order. Each
+        sibling list is only walked once"""
+        groups = OrderedDict()
+        top_level = []
         for e in self:
-            current = getattr(e, method)()
-            while current is not None:
-                yield current
-                current = getattr(current, method)()
-
-    def _traverse_parent_topdown(self):
-        for e in self:
-            this_list = []
-            current = e.getparent()
-            while current is not None:
-                this_list.append(current)
-                current = current.getparent()
-            this_list.reverse()
-            for j in this_list:
-                yield j
-
-    def _next_all(self):
-        return [e for e in self._traverse('getnext')]
+            parent = e.getparent()
+            if parent is None:
+                # top level comments and processing instructions
+                if before:
+                    top_level.extend(e.itersiblings(preceding=True))
+                if after:
+                    top_level.extend(e.itersiblings())
+            else:
+                groups.setdefault(parent, set()).add(e)
+        results = []
+        for parent in groups:
+            selected = groups[parent]
+            children = list(parent.iterchildren())
+            indexes = [i for i, child in enumerate(children)
+                       if child in selected]
+            first, last = indexes[0], indexes[-1]
+            if not after:
+                results.extend(children[:last])
+            elif not before:
+                results.extend(children[first + 1:])
+            elif first == last:
+                results.extend(children[:first])
+                results.extend(children[first + 1:])
+            else:
+                results.extend(children)
+        if top_level:
+            results = document_order(unique_elements(results + top_level))
+        elif len(groups) > 1:
+            # sibling lists are disjoint but the ones of nested parents
+            # interleave
+            results = document_order(results)
+        return results
 
     @with_camel_case_alias
     def next_all(self, selector=None):
@@ -508,10 +1292,7 @@ class PyQuery(list):
         >>> d('p:last').nextAll()
         [<img>]
         """
-        return self._filter_only(selector, self._next_all())
-
-    def _prev_all(self):
-        return [e for e in self._traverse('getprevious')]
+        return self._filter_only(selector, self._siblings(before=False))
 
     @with_camel_case_alias
     def prev_all(self, selector=None):
@@ -523,7 +1304,7 @@ class PyQuery(list):
         >>> d('p:last').prevAll()
         [<p.hello>]
         """
-        return self._filter_only(selector, self._prev_all(), reverse=True)
+        return self._filter_only(selector, self._siblings(after=False))
 
     def siblings(self, selector=None):
         """
@@ -535,7 +1316,7 @@ class PyQuery(list):
          [<img>]
 
         """
-        return self._filter_only(selector, self._prev_all() + self._next_all())
+        return self._filter_only(selector, self._siblings())
 
     def parents(self, selector=None):
         """
@@ -547,11 +1328,14 @@ class PyQuery(list):
         >>> d('.hello').parents('p')
         []
         """
-        return self._filter_only(
-            selector,
-            [e for e in self._traverse_parent_topdown()],
-            unique=True
-        )
+        seen = set()
+        for e in self:
+            current = e.getparent()
+            # stop at the first known ancestor: its ancestors are known too
+            while current is not None and current not in seen:
+                seen.add(current)
+                current = current.getparent()
+        return self._filter_only(selector, list(seen), unique=True)
 
     def children(self, selector=None):
         """Filter elements that are direct children of self using optional
@@ -580,14 +1364,52 @@ class PyQuery(list):
         >>> d('strong').closest('form')
         []
         """
+        match = self._matcher(selector, self)
+        # closest match of visited elements. Shared ancestors are only
+        # tested once
+        memo = {}
         result = []
         for current in self:
-            while (current is not None and
-                    not self._copy(current).is_(selector)):
+            path = []
+            while current is not None and current not in memo:
+                if match(current):
+                    break
+                path.append(current)
+                current = current.getparent()
+            found = memo.get(current, current)
+            for tag in path:
+                memo[tag] = found
+            if found is not None:
+                memo[found] = found
+                result.append(found)
+        return self._filter_only(None, result, unique=True)
+
+    @with_camel_case_alias
+    def parents_until(self, selector=None, filter=None):
+        """Ancestors of elements up to but not including the first one
+        matching selector, optionally filtered by filter:
+
+            >>> d = PyQuery('<div><ul><li><b>1</b></li></ul></div>')
+            >>> d('b').parents_until('div')
+            [<ul>, <li>]
+            >>> d('b').parentsUntil('div', 'li')
+            [<li>]
+        """
+        match = None
+        if selector is not None:
+            match = self._matcher(selector, self)
+        seen = set()
+        results = []
+        for e in self:
+            current = e.getparent()
+            # the path above a known ancestor is known too
+            while current is not None and current not in seen:
+                seen.add(current)
+                if match is not None and match(current):
+                    break
+                results.append(current)
                 current = current.getparent()
-            if current is not None:
-                result.append(current)
-        return self._copy(result, parent=self)
+        return self._filter_only(filter, results, unique=True)
 
     def contents(self):
         """
@@ -597,11 +1419,12 @@ class PyQuery(list):
             >>> d.contents()  # doctest: +ELLIPSIS
             ['hello ', <Element b at ...>]
         """
+        xpath = compiled_xpath('child::text()|child::*', self.namespaces)
         results = []
         for elem in self:
-            results.extend(elem.xpath('child::text()|child::*',
-                           namespaces=self.namespaces))
-        return self._copy(results, parent=self)
+            if isinstance(elem.tag, basestring):
+                results.extend(xpath(elem))
+        return self._derive(results)
 
     def filter(self, selector):
         """Filter elements in self using selector (string or function):
@@ -621,19 +1444,8 @@ class PyQuery(list):
         if not hasattr(selector, '__call__'):
             return self._filter_only(selector, self)
         else:
-            elements = []
-            args = getargspec(callback)
-            try:
-                for i, this in enumerate(self):
-                    if len(args) == 1:
-                        func_globals(selector)['this'] = this
-                    if callback(selector, i, this):
-                        elements.append(this)
-            finally:
-                f_globals = func_globals(selector)
-                if 'this' in f_globals:
-                    del f_globals['this']
-            return self._copy(elements, parent=self)
+            results = Callback(selector).results(self)
+            return self._derive([this for this in self if next(results)])
 
     def not_(self, selector):
         """Return elements that don't match the given selector:
@@ -643,8 +1455,7 @@ class PyQuery(list):
             [<p>]
         """
         exclude = set(self._copy(selector, self))
-        return self._copy([e for e in self if e not in exclude],
-                          parent=self)
+        return self._derive([e for e in self if e not in exclude])
 
     def is_(self, selector):
         """Returns True if selector matches at least one current element, else
@@ -662,9 +1473,68 @@ class PyQuery(list):
 
         ..
         """
-        return bool(self._filter_only(selector, self))
+        match = self._matcher(selector)
+        return any(match(tag) for tag in self)
+
+    def exists(self, selector=None):
+        """Return True if selector matches at least one element in self or
+        their descendants, like ``bool(self(selector))`` but without
+        building the selection. Simple selectors stop at the first match:
 
-    def find(self, selector):
+            >>> d = PyQuery('<div><p class="hello">Hi</p></div>')
+            >>> d.exists('p.hello')
+            True
+            >>> d.exists('p:contains("Bye")')
+            False
+        """
+        if selector is None:
+            return bool(self)
+        if self._simple_selector(selector) is not None:
+            for tag in self._iter(selector, self):
+                return True
+            return False
+        evaluate = self._wrapped_xpath(selector, 'boolean(%s)')
+        return any(evaluate(tag) for tag in self
+                   if isinstance(tag.tag, basestring))
+
+    def count(self, selector=None):
+        """Return the number of elements matching selector in self and their
+        descendants, like ``len(self(selector))`` but without building the
+        selection:
+
+            >>> d = PyQuery('<div><p>Hi</p><p>Bye</p></div>')
+            >>> d.count('p')
+            2
+            >>> d('p').count()
+            2
+
+        Other values, and strings in selections which are not only made of
+        elements (e.g. the results of :meth:`map`), are counted like with
+        ``list.count()``::
+
+            >>> d('p').map(lambda i, e: PyQuery(e).text()).count('Hi')
+            1
+        """
+        if selector is None:
+            return len(self)
+        if not isinstance(selector, (Selector,) + string_types):
+            return list.count(self, selector)
+        if not isinstance(selector, Selector) and not all(
+                isinstance(e, etree._Element) for e in self):
+            return list.count(self, selector)
+        simple = self._simple_selector(selector)
+        if simple is not None and self._index is not None:
+            results = self._index.select(simple, outermost(self))
+            if results is not None:
+                return len(results)
+        if len(self) > 1 and not is_context_free(
+                self._css_to_xpath(selector)):
+            return len(self._select(selector, self))
+        evaluate = self._wrapped_xpath(selector, 'count(%s)')
+        # nested contexts would count elements twice
+        return sum(int(evaluate(tag)) for tag in outermost(self))
+
+    def find(self, selector, limit=None):
         """Find elements using selector traversing down from self:
 
             >>> m = '<p><span><em>Whoah!</em></span></p><p><em> there</em></p>'
@@ -673,16 +1543,27 @@ class PyQuery(list):
             [<em>, <em>]
             >>> d('p').eq(1).find('em')
             [<em>]
+
+        ``limit`` stops the search after that many elements (in document
+        order)::
+
+            >>> d('p').find('em', limit=1).text()
+            'Whoah!'
         """
-        xpath = self._css_to_xpath(selector)
-        results = [child.xpath(xpath, namespaces=self.namespaces)
-                   for tag in self
-                   for child in tag.getchildren()]
-        # Flatten the results
-        elements = []
-        for r in results:
-            elements.extend(r)
-        return self._copy(elements, parent=self)
+        elements = self._select(selector, self, strict=True, limit=limit)
+        return self._derive(elements)
+
+    def find_one(self, selector):
+        """Find the first element matching selector traversing down from
+        self. The search stops as soon as it is found:
+
+            >>> d = PyQuery('<p><em>1</em><em>2</em></p>')
+            >>> d.find_one('em')
+            [<em>]
+            >>> d.find_one('b')
+            []
+        """
+        return self.find(selector, limit=1)
 
     def eq(self, index):
         """Return PyQuery of only the element with the provided index::
@@ -700,23 +1581,35 @@ class PyQuery(list):
         # Slicing will return empty list when index=-1
         # we should handle out of bound by ourselves
         try:
-            items = self[index]
+            items = [self[index]]
         except IndexError:
             items = []
-        return self._copy(items, parent=self)
+        return self._derive(items)
+
+    def first(self, selector=None):
+        """Return PyQuery of the first element. If selector is given, return
+        the first element matching selector in self and their descendants,
+        like ``self(selector).eq(0)`` but the search stops as soon as it is
+        found::
+
+            >>> d = PyQuery('<div><p class="hello">Hi</p><p>Bye</p></div>')
+            >>> d('p').first()
+            [<p.hello>]
+            >>> d.first('p')
+            [<p.hello>]
+
+        ..
+        """
+        if selector is None:
+            return self.eq(0)
+        return self(selector, limit=1)
 
     def each(self, func):
         """apply func on each nodes
         """
-        try:
-            for i, element in enumerate(self):
-                func_globals(func)['this'] = element
-                if callback(func, i, element) is False:
-                    break
-        finally:
-            f_globals = func_globals(func)
-            if 'this' in f_globals:
-                del f_globals['this']
+        for result in Callback(func).results(self):
+            if result is False:
+                break
         return self
 
     def map(self, func):
@@ -737,20 +1630,13 @@ class PyQuery(list):
 
         """
         items = []
-        try:
-            for i, element in enumerate(self):
-                func_globals(func)['this'] = element
-                result = callback(func, i, element)
-                if result is not None:
-                    if not isinstance(result, list):
-                        items.append(result)
-                    else:
-                        items.extend(result)
-        finally:
-            f_globals = func_globals(func)
-            if 'this' in f_globals:
-                del f_globals['this']
-        return self._copy(items, parent=self)
+        for result in Callback(func).results(self):
+            if result is not None:
+                if not isinstance(result, list):
+                    items.append(result)
+                else:
+                    items.extend(result)
+        return self._derive(items)
 
     @property
     def length(self):
@@ -798,14 +1684,14 @@ class PyQuery(list):
         elif isinstance(attr, dict):
             for tag in self:
                 for key, value in attr.items():
-                    tag.set(key, value)
+                    self._set_attribute(tag, key, value)
         elif value is no_default:
             return self[0].get(attr)
         elif value is None:
             return self.remove_attr(attr)
         else:
             for tag in self:
-                tag.set(attr, value)
+                self._set_attribute(tag, attr, value)
         return self
 
     @with_camel_case_alias
@@ -821,14 +1707,88 @@ class PyQuery(list):
         ..
         """
         for tag in self:
-            try:
+            old = tag.get(name)
+            if old is not None:
                 del tag.attrib[name]
-            except KeyError:
-                pass
+                index = find_index((tag,))
+                if index is not None:
+                    index.attribute_changed(tag, name, old, None)
         return self
 
     attr = FlexibleElement(pget=attr, pdel=remove_attr)
 
+    def create_index(self, *attributes):
+        """Build id, class and tag indexes of the whole document. Simple
+        ``#id``, ``.class`` and ``tag`` selections made from this object and
+        the objects derived from it are then answered from the indexes::
+
+            >>> d = PyQuery('<div><p class="x">1</p><p>2</p></div>')
+            >>> d = d.create_index()
+            >>> d('.x')
+            [<p.x>]
+            >>> d('p').eq(1).add_class('x')
+            [<p.x>]
+            >>> d('.x')
+            [<p.x>, <p.x>]
+
+        Other attributes can be indexed by value. They are used by
+        ``[attr=value]`` selectors and :meth:`lookup`::
+
+            >>> d = PyQuery('<ul><li data-sku="1">a</li><li>b</li></ul>')
+            >>> d = d.create_index('data-sku')
+            >>> d('[data-sku="1"]')
+            [<li>]
+
+        The indexes belong to the document: every PyQuery object of the
+        document uses them, e.g. ``PyQuery(element)`` built in a callback,
+        and its mutations keep them up to date. Call :meth:`invalidate_index`
+        after modifying the tree with lxml.
+        """
+        index = find_index(self)
+        if index is not None:
+            index.add_attributes(attributes)
+        elif self:
+            index = DocumentIndex(self[0], attributes)
+        self._index = index
+        return self
+
+    def lookup(self, attr, value):
+        """Return elements (self or descendants) where attribute attr is
+        value. Uses the index created by :meth:`create_index` if any::
+
+            >>> d = PyQuery('<ul><li name="a">a</li><li name="b">b</li></ul>')
+            >>> d.create_index('name').lookup('name', 'b').text()
+            'b'
+        """
+        if attr == 'id':
+            simple = fastpath.SimpleSelector(id=value)
+        else:
+            simple = fastpath.SimpleSelector(attr=attr, value=value)
+        results = None
+        if self._index is not None:
+            results = self._index.select(simple, self)
+        if results is None:
+            results = [el for tag in self for el in simple.iter(tag)]
+        return self._derive(results)
+
+    def invalidate_index(self):
+        """Mark the document indexes as outdated. They are rebuilt on next
+        lookup"""
+        for index in find_indexes(self):
+            index.invalidate()
+        if self._index is not None:
+            # the root of the document may have changed
+            self._index.invalidate()
+
+    def _set_attribute(self, tag, name, value):
+        index = find_index((tag,))
+        if index is None:
+            tag.set(name, value)
+        else:
+            old = tag.get(name)
+            tag.set(name, value)
+            index.attribute_changed(tag, name, old, value)
+
     #######
     # CSS #
     #######
@@ -854,7 +1814,8 @@ class PyQuery(list):
 
         ..
         """
-        return self.is_('.%s' % name)
+        match = fastpath.SimpleSelector(class_=name).match
+        return any(match(tag) for tag in self)
 
     @with_camel_case_alias
     def add_class(self, value):
@@ -872,7 +1833,7 @@ class PyQuery(list):
             values = value.split(' ')
             classes = (tag.get('class') or '').split()
             classes += [v for v in values if v not in classes]
-            tag.set('class', ' '.join(classes))
+            self._set_attribute(tag, 'class', ' '.join(classes))
         return self
 
     @with_camel_case_alias
@@ -894,9 +1855,9 @@ class PyQuery(list):
             classes.difference_update([''])
             classes = ' '.join(classes)
             if classes.strip():
-                tag.set('class', classes)
+                self._set_attribute(tag, 'class', classes)
             elif tag.get('class'):
-                tag.set('class', classes)
+                self._set_attribute(tag, 'class', classes)
         return self
 
     @with_camel_case_alias
@@ -917,7 +1878,7 @@ class PyQuery(list):
             values_to_del = [v for v in values if v in classes]
             classes = [v for v in classes if v not in values_to_del]
             classes += values_to_add
-            tag.set('class', ' '.join(classes))
+            self._set_attribute(tag, 'class', ' '.join(classes))
         return self
 
     def css(self, *args, **kwargs):
@@ -946,7 +1907,7 @@ class PyQuery(list):
                 for key, value in attr.items():
                     key = key.replace('_', '-')
                     current.append('%s: %s' % (key, value))
-                tag.set('style', '; '.join(current))
+                self._set_attribute(tag, 'style', '; '.join(current))
         elif isinstance(value, basestring):
             attr = attr.replace('_', '-')
             for tag in self:
@@ -956,7 +1917,7 @@ class PyQuery(list):
                     if (el.strip() and
                         not el.split(':')[0].strip() == attr.strip())]
                 current.append('%s: %s' % (attr, value))
-                tag.set('style', '; '.join(current))
+                self._set_attribute(tag, 'style', '; '.join(current))
         return self
 
     css = FlexibleElement(pget=css, pset=css)
@@ -1127,15 +2088,13 @@ class PyQuery(list):
             else:
                 raise ValueError(type(value))
 
-            for tag in self:
-                for child in tag.getchildren():
-                    tag.remove(child)
-                root = fromstring(
-                    u'<root>' + new_html + u'</root>',
-                    self.parser)[0]
-                children = root.getchildren()
-                if children:
-                    tag.extend(children)
+            self.invalidate_index()
+            root = fromstring(
+                u'<root>' + new_html + u'</root>',
+                self.parser, parser_options=self.parser_options)[0]
+            for tag, children in zip(self, _copies(root, len(self))):
+                del tag[:]
+                tag.extend(children)
                 tag.text = root.text
         return self
 
@@ -1204,6 +2163,7 @@ class PyQuery(list):
                 extract_text(tag, **kwargs) for tag in self
             )
 
+        self.invalidate_index()
         for tag in self:
             for child in tag.getchildren():
                 tag.remove(child)
@@ -1217,11 +2177,13 @@ class PyQuery(list):
     def _get_root(self, value):
         if isinstance(value, basestring):
             root = fromstring(u'<root>' + value + u'</root>',
-                              self.parser)[0]
+                              self.parser,
+                              parser_options=self.parser_options)[0]
         elif isinstance(value, etree._Element):
             root = self._copy(value)
         elif isinstance(value, PyQuery):
             root = value
+            value.invalidate_index()
         else:
             raise TypeError(
                 'Value must be string, PyQuery or Element. Got %r' % value)
@@ -1235,7 +2197,8 @@ class PyQuery(list):
         """append value to each nodes
         """
         root, root_text = self._get_root(value)
-        for i, tag in enumerate(self):
+        self.invalidate_index()
+        for tag, children in zip(self, _copies(root, len(self))):
             if len(tag) > 0:  # if the tag has children
                 last_child = tag[-1]
                 if not last_child.tail:
@@ -1245,9 +2208,7 @@ class PyQuery(list):
                 if not tag.text:
                     tag.text = ''
                 tag.text += root_text
-            if i > 0:
-                root = deepcopy(list(root))
-            tag.extend(root)
+            tag.extend(children)
         return self
 
     @with_camel_case_alias
@@ -1255,24 +2216,23 @@ class PyQuery(list):
         """append nodes to value
         """
         value.append(self)
+        self.invalidate_index()
         return self
 
     def prepend(self, value):
         """prepend value to nodes
         """
         root, root_text = self._get_root(value)
-        for i, tag in enumerate(self):
+        self.invalidate_index()
+        for tag, children in zip(self, _copies(root, len(self))):
             if not tag.text:
                 tag.text = ''
-            if len(root) > 0:
-                root[-1].tail = tag.text
+            if children:
+                children[-1].tail = (children[-1].tail or '') + tag.text
                 tag.text = root_text
             else:
                 tag.text = root_text + tag.text
-            if i > 0:
-                root = deepcopy(list(root))
-            tag[:0] = root
-            root = tag[:len(root)]
+            tag[:0] = children
         return self
 
     @with_camel_case_alias
@@ -1280,22 +2240,23 @@ class PyQuery(list):
         """prepend nodes to value
         """
         value.prepend(self)
+        self.invalidate_index()
         return self
 
     def after(self, value):
         """add value after nodes
         """
         root, root_text = self._get_root(value)
-        for i, tag in enumerate(self):
+        self.invalidate_index()
+        for tag, children in zip(self, _copies(root, len(self))):
             if not tag.tail:
                 tag.tail = ''
             tag.tail += root_text
-            if i > 0:
-                root = deepcopy(list(root))
-            parent = tag.getparent()
-            index = parent.index(tag) + 1
-            parent[index:index] = root
-            root = parent[index:len(root)]
+            # addnext() does not look for the index of tag in its parent
+            previous = tag
+            for child in children:
+                previous.addnext(child)
+                previous = child
         return self
 
     @with_camel_case_alias
@@ -1303,13 +2264,15 @@ class PyQuery(list):
         """insert nodes after value
         """
         value.after(self)
+        self.invalidate_index()
         return self
 
     def before(self, value):
         """insert value before nodes
         """
         root, root_text = self._get_root(value)
-        for i, tag in enumerate(self):
+        self.invalidate_index()
+        for tag, children in zip(self, _copies(root, len(self))):
             previous = tag.getprevious()
             if previous is not None:
                 if not previous.tail:
@@ -1320,12 +2283,8 @@ class PyQuery(list):
                 if not parent.text:
                     parent.text = ''
                 parent.text += root_text
-            if i > 0:
-                root = deepcopy(list(root))
-            parent = tag.getparent()
-            index = parent.index(tag)
-            parent[index:index] = root
-            root = parent[index:len(root)]
+            for child in children:
+                tag.addprevious(child)
         return self
 
     @with_camel_case_alias
@@ -1333,6 +2292,7 @@ class PyQuery(list):
         """insert nodes before value
         """
         value.before(self)
+        self.invalidate_index()
         return self
 
     def wrap(self, value):
@@ -1348,6 +2308,7 @@ class PyQuery(list):
         """
         assert isinstance(value, basestring)
         value = fromstring(value)[0]
+        self.invalidate_index()
         nodes = []
         for tag in self:
             wrapper = deepcopy(value)
@@ -1390,6 +2351,7 @@ class PyQuery(list):
 
         assert isinstance(value, basestring)
         value = fromstring(value)[0]
+        self.invalidate_index()
         wrapper = deepcopy(value)
         if not wrapper.getchildren():
             child = wrapper
@@ -1434,6 +2396,7 @@ class PyQuery(list):
         """
         if isinstance(value, PyQuery):
             value = str(value)
+        self.invalidate_index()
         if hasattr(value, '__call__'):
             for i, element in enumerate(self):
                 self._copy(element).before(
@@ -1465,6 +2428,7 @@ class PyQuery(list):
     def empty(self):
         """remove nodes content
         """
+        self.invalidate_index()
         for tag in self:
             tag.text = None
             tag[:] = []
@@ -1483,6 +2447,7 @@ class PyQuery(list):
              <div>Maybe <em>she</em> does   know</div>
         """
         if expr is no_default:
+            self.invalidate_index()
             for tag in self:
                 parent = tag.getparent()
                 if parent is not None:
@@ -1516,9 +2481,10 @@ class PyQuery(list):
 
         """
         def __setattr__(self, name, func):
+            callback = Callback(func, trim=False)
+
             def fn(self, *args, **kwargs):
-                func_globals(func)['this'] = self
-                return func(*args, **kwargs)
+                return callback(self, *args, **kwargs)
             fn.__name__ = name
             setattr(PyQuery, name, fn)
     fn = Fn()
@@ -1655,6 +2621,81 @@ class PyQuery(list):
                 ret[name].append(val)
         return ret
 
+    def select_many(self, selectors):
+        """Evaluate many selectors at once. Return an ordered dict of PyQuery
+        objects, one per selector. Simple selectors (see
+        :mod:`pyquery.fastpath`) are all matched during a single walk of the
+        tree, others are evaluated one by one::
+
+            >>> d = PyQuery('<div><h1>Title</h1><p class="price">12</p>'
+            ...             '<p>Other</p></div>')
+            >>> found = d.select_many({'title': 'h1', 'price': '.price',
+            ...                        'last': 'p:last'})
+            >>> found['title'].text(), found['price'].text()
+            ('Title', '12')
+            >>> found['last'].text()
+            'Other'
+
+        selectors can also be a list of ``(name, selector)`` pairs.
+        """
+        if hasattr(selectors, 'items'):
+            selectors = selectors.items()
+        found = OrderedDict()
+        by_tag = {}
+        by_id = {}
+        by_class = {}
+        by_attr = {}
+        others = []
+        for name, selector in selectors:
+            simple = self._simple_selector(selector)
+            if simple is None or self._index is not None:
+                others.append((name, selector))
+            elif simple.id is not None:
+                by_id.setdefault(simple.id, []).append((name, simple))
+            elif simple.class_ is not None:
+                by_class.setdefault(simple.class_, []).append((name, simple))
+            elif simple.attr is not None:
+                by_attr.setdefault(simple.attr, {}).setdefault(
+                    simple.value, []).append((name, simple))
+            else:
+                by_tag.setdefault(simple.tag, []).append((name, simple))
+            found[name] = []
+        by_attr = list(by_attr.items())
+
+        if by_tag or by_id or by_class or by_attr:
+            # nested contexts would yield their descendants twice
+            for tag in outermost(self):
+                for el in tag.iter(etree.Element):
+                    matches = by_tag.get(el.tag)
+                    if matches:
+                        for name, simple in matches:
+                            found[name].append(el)
+                    if by_id:
+                        value = el.get('id')
+                        if value is not None and value in by_id:
+                            for name, simple in by_id[value]:
+                                if simple.match(el):
+                                    found[name].append(el)
+                    if by_class:
+                        value = el.get('class')
+                        if value:
+                            for class_ in set(fastpath.split_classes(value)):
+                                for name, simple in by_class.get(class_, ()):
+                                    if simple.match(el):
+                                        found[name].append(el)
+                    for attr, values in by_attr:
+                        value = el.get(attr)
+                        if value is not None and value in values:
+                            for name, simple in values[value]:
+                                if simple.match(el):
+                                    found[name].append(el)
+
+        for name, selector in others:
+            found[name] = self._select(selector, self)
+        for name, elements in found.items():
+            found[name] = self._derive(elements)
+        return found
+
     @property
     def base_url(self):
         """Return the url of current html document or None if not available.
@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+"""Choose a parser before parsing a document. See :func:`sniff_parser`"""
+import re
+
+#: number of characters looked at
+window = 65536
+
+#: shorter documents are not sniffed by
+#: :func:`~pyquery.pyquery.fromstring`. A failed xml parse is cheap enough
+min_size = 4096
+
+_prolog = re.compile(r'(?:\s|<\?.*?\?>|<!--.*?-->)*', re.S)
+_internal_subset = re.compile(r'<!DOCTYPE[^>\[]*\[')
+_entity = re.compile(r'&(?!(?:amp|lt|gt|quot|apos);)[A-Za-z_][\w.-]*;')
+# a void element which is not closed, followed by the end tag of another one
+_unclosed_void_element = re.compile(r'''
+    <(?=[abceilmpstw])
+    (area|base|br|col|embed|hr|img|input|link|meta|param|source|track|wbr)
+    (?:\s[^"'>]*(?:(?:"[^"]*"|'[^']*')[^"'>]*)*)?(?<!/)>
+    [^<]*</(?!\1[\s>])''', re.X)
+_markup = (('<!--', '-->'), ('<![CDATA[', ']]>'), ('<?', '?>'))
+
+
+def _in_markup(text, position):
+    """True if position is in a comment, a CDATA section or a processing
+    instruction"""
+    for start, end in _markup:
+        i = text.rfind(start, 0, position)
+        if i != -1:
+            i = text.find(end, i + len(start))
+            if i == -1 or i + len(end) > position:
+                return True
+    return False
+
+
+def _search(pattern, text):
+    """first match of pattern out of comments, CDATA sections and
+    processing instructions"""
+    for match in pattern.finditer(text):
+        if not _in_markup(text, match.start()):
+            return match
+    return None
+
+
+def sniff_parser(document):
+    """Return ``'html'`` when the start of document (a string or a file
+    opened in binary mode) shows that the xml parser will fail, else None::
+
+        >>> print(sniff_parser('<!doctype html><p>Hi'))
+        html
+        >>> print(sniff_parser('<html><p>Hi&nbsp;<br></p></html>'))
+        html
+        >>> print(sniff_parser('<html><p>Hi<br/></p></html>'))
+        None
+
+    The signs looked for are some of the usual html differences: a lower
+    case doctype and text out of the root element, then, in documents with
+    an html doctype or root element, void elements (``<br>``) which are not
+    closed and html entities (``&nbsp;``). They are searched with regular
+    expressions, which is faster than a failed xml parse of a page. Other
+    documents are not scanned: xml parsing of a snippet fails quickly. None
+    does not mean that the document is well formed.
+    """
+    if hasattr(document, 'read'):
+        if not hasattr(document, 'seek'):
+            return None
+        position = document.tell()
+        text = document.read(window)
+        document.seek(position)
+    else:
+        text = document[:window]
+    if isinstance(text, bytes):
+        if text[:2] in (b'\xff\xfe', b'\xfe\xff') or b'\x00' in text[:4]:
+            # utf-16 or utf-32
+            return None
+        text = text.decode('latin-1')
+    start = _prolog.match(text).end()
+    if start == len(text):
+        return None
+    if text.startswith('<!DOCTYPE', start):
+        if _internal_subset.match(text, start):
+            # entities can be declared
+            return None
+    elif text.startswith('<!', start) and not text.startswith('<!--', start):
+        return 'html'
+    elif not text.startswith('<', start):
+        return 'html'
+    if not (text.startswith('<!DOCTYPE html', start) or
+            text.startswith('<html', start)):
+        return None
+    if (_search(_unclosed_void_element, text) or
+            _search(_entity, text)):
+        return 'html'
+    return None
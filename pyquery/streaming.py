@@ -0,0 +1,112 @@
+# -*- coding:utf-8 -*-
+#
+# Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
+#
+# Distributed under the BSD license, see LICENSE.txt
+"""Incremental parsing of documents too large to fit in memory"""
+from .pyquery import PyQuery
+from lxml import etree
+
+
+def iterparse(source, selector, parser='xml', namespaces=None, **kwargs):
+    """Parse source (a filename or a file object) incrementally and yield a
+    :class:`~pyquery.pyquery.PyQuery` for each element matching selector::
+
+        >>> from io import BytesIO
+        >>> feed = BytesIO(b'<feed><p id="1"><b>x</b></p><p id="2"/></feed>')
+        >>> for product in iterparse(feed, 'p'):
+        ...     print(product.attr('id'), len(product.find('b')))
+        1 1
+        2 0
+
+    An element is tested once it is completely parsed: selector can use
+    its content and its ancestors, but not its siblings. Once an element is
+    yielded, it is cleared and removed from the document with the preceding
+    siblings of its ancestors, so memory stays bounded. Keep values, not
+    elements, between iterations. Matching elements nested in another
+    matching element are kept until the outer element is yielded. Elements
+    which don't match are removed as soon as they can't be the content of
+    a match (this needs a tag name at the right of selector: ``p.x``, not
+    ``.x``). Positional pseudo classes (``:first``, ``:eq()``...) are not
+    supported.
+
+    parser is ``'xml'`` or ``'html'``. Other keyword arguments are passed
+    to ``lxml.etree.iterparse`` (e.g. ``huge_tree=True``).
+    """
+    if parser not in ('xml', 'html'):
+        raise ValueError('No such parser: "%s"' % parser)
+    query = PyQuery([], parser=parser, namespaces=namespaces)
+    match = query._matcher(selector)
+    # the tag of all matches, if any
+    tag = query._selected_tag(selector)
+    events = etree.iterparse(source, events=('end',),
+                             html=parser == 'html', **kwargs)
+    for _, element in events:
+        if match(element):
+            yield query._derive([element])
+            if any(match(ancestor) for ancestor in element.iterancestors()):
+                # removed with the outer element
+                continue
+        elif tag is None or next(element.iterancestors(tag), None) is not None:
+            # may be in a match
+            continue
+        _discard(element)
+
+
+def _discard(element):
+    """clear a parsed element and remove what precedes it and its
+    ancestors from the document"""
+    element.clear()
+    parent = element.getparent()
+    while parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+        element, parent = parent, parent.getparent()
+
+
+class FeedParser(object):
+    """Parse a document arriving in chunks. See
+    :meth:`pyquery.pyquery.PyQuery.feed_parser`"""
+
+    def __init__(self, parser='html', namespaces=None, cls=PyQuery,
+                 **kwargs):
+        if parser == 'xml':
+            self.parser = etree.XMLPullParser(events=('end',), **kwargs)
+        elif parser == 'html':
+            import lxml.html
+            self.parser = etree.HTMLPullParser(events=('end',), **kwargs)
+            # same elements as lxml.html.fromstring()
+            self.parser.set_element_class_lookup(
+                lxml.html.HtmlElementClassLookup())
+        else:
+            raise ValueError('No such parser: "%s"' % parser)
+        self.query = cls([], parser=parser, namespaces=namespaces)
+        self.callbacks = []
+
+    def on(self, selector, callback):
+        """Call ``callback(element)`` with a PyQuery for each element
+        matching selector as soon as it is completely parsed. Return the
+        parser"""
+        self.callbacks.append((self.query._matcher(selector), callback))
+        return self
+
+    def feed(self, data):
+        """Parse a chunk of the document (bytes or text)"""
+        self.parser.feed(data)
+        self._dispatch()
+
+    def close(self):
+        """Finish parsing and return a PyQuery for the root of the
+        document"""
+        root = self.parser.close()
+        self._dispatch()
+        query = self.query
+        return query.__class__(root, parser=query.parser,
+                               namespaces=query.namespaces)
+
+    def _dispatch(self):
+        callbacks = self.callbacks
+        for _, element in self.parser.read_events():
+            for match, callback in callbacks:
+                if match(element):
+                    callback(self.query._derive([element]))
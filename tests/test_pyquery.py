@@ -3,12 +3,22 @@
 # Copyright (C) 2008 - Olivier Lauzanne <olauzanne@gmail.com>
 #
 # Distributed under the BSD license, see LICENSE.txt
+import multiprocessing
 import os
+import shutil
 import sys
+import tempfile
+import threading
 import time
+from itertools import islice
 from lxml import etree
-from pyquery.pyquery import PyQuery as pq, no_default
+from pyquery.pyquery import PyQuery as pq, no_default, compiled_xpath
+from pyquery.pyquery import document_order
 from pyquery.openers import HAS_REQUEST
+from pyquery.cache import LRUCache, css_cache, xpath_cache, document_cache
+from pyquery.cache import fragment_cache
+from pyquery.batch import query_files
+from pyquery import cache
 from webtest import http
 from webtest.debugapp import debug_app
 from .compat import PY3k
@@ -298,6 +308,1040 @@ class TestTraversal(TestCase):
         assert self.klass('.node3', self.html).closest('form') == []
 
 
+class TestCssCache(TestCase):
+
+    def test_translation_is_cached(self):
+        css_cache.clear()
+        d = pq('<div><p class="a">1</p><p>2</p></div>')
+        self.assertEqual(len(d('div > p.a')), 1)
+        self.assertEqual(len(d('div > p.a')), 1)
+        info = css_cache.info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 1)
+
+    def test_translator_is_part_of_the_key(self):
+        css_cache.clear()
+        self.assertEqual(len(pq('<X>foo</X>', parser='xml')('X:first')), 1)
+        self.assertEqual(len(pq('<X>foo</X>', parser='html')('X:first')), 1)
+        self.assertEqual(css_cache.info().misses, 2)
+
+    def test_xpath_is_compiled_once(self):
+        xpath_cache.clear()
+        d = pq('<div>' + '<p><b>1</b></p>' * 20 + '</div>')
+        self.assertEqual(len(d('div p').find('b:first')), 20)
+        self.assertEqual(len(d('div p').filter('p:first')), 20)
+        self.assertEqual(xpath_cache.info().misses, 3)
+
+    def test_compiled_xpath_namespaces_key(self):
+        ns = {'bar': 'http://example.com/bar'}
+        self.assertIs(compiled_xpath('//bar:a', dict(ns)),
+                      compiled_xpath('//bar:a', dict(ns)))
+        self.assertIsNot(compiled_xpath('//a'),
+                         compiled_xpath('//a', smart_strings=False))
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.info().evictions, 1)
+        self.assertEqual(len(cache), 2)
+
+
+class TestCompiledSelector(TestCase):
+    html = '''<div id="a" class="x"><p class="x"><b>1</b></p>
+              <p><b>2</b></p></div>'''
+
+    def test_selector_everywhere(self):
+        import pyquery
+        x = pyquery.compile('.x')
+        b = pyquery.compile('b')
+        d = pq(self.html)
+        self.assertEqual(len(d(x)), 2)
+        self.assertEqual(len(pq(x, self.html)), 2)
+        self.assertEqual(len(d('p').find(b)), 2)
+        self.assertEqual(len(d('p').filter(x)), 1)
+        self.assertEqual(len(d('p').not_(x)), 1)
+        self.assertTrue(d('p').is_(x))
+        self.assertEqual([e.tag for e in d('b').closest(x)], ['div', 'p'])
+        self.assertEqual(len(d('p').children(b)), 2)
+        self.assertEqual(d('b').parents(x)[0].tag, 'div')
+
+    def test_selector_is_immutable_and_picklable(self):
+        import pickle
+        sel = pq.compile('bar|blah', namespaces={'bar': 'http://bar'})
+        self.assertRaises(AttributeError, setattr, sel, 'xpath', '')
+        clone = pickle.loads(pickle.dumps(sel))
+        self.assertEqual(clone, sel)
+        d = pq('<foo xmlns:bar="http://bar"><bar:blah>What</bar:blah></foo>',
+               parser='xml')
+        self.assertEqual(d(clone).text(), 'What')
+
+
+class TestFastPath(TestCase):
+    html = '''<div id="main" class="a  b"><!-- comment -->
+        <p class="b" data-k="1">1</p><P class="c	b">2</P>
+        <span id="x" class="b-c" data-k='2'>3</span>
+        <p class="bb">4</p></div>'''
+    xml = '''<root xmlns:n="urn:n"><p class="b"/><n:p class="b"/>
+        <P id="x"/><q xmlns="urn:q" class="b"/></root>'''
+    selectors = ['p', 'P', 'span', '#x', '#main', '.b', '.b-c', 'p.b',
+                 'div.b', '[data-k="1"]', "[data-k='2']", '[data-k=a]',
+                 'span[data-k="2"]', 'p#x', 'span#x', '[id=x]', 'q']
+
+    def assertSameResults(self, doc):
+        for selector in self.selectors:
+            assert doc._simple_selector(selector) is not None, selector
+            native = (doc(selector), doc('*').filter(selector),
+                      doc.find(selector))
+            pq._fast_path = False
+            try:
+                expected = (doc(selector), doc('*').filter(selector),
+                            doc.find(selector))
+            finally:
+                pq._fast_path = True
+            self.assertEqual(native, expected, selector)
+
+    def test_html(self):
+        self.assertSameResults(pq(self.html))
+        self.assertSameResults(pq(self.html, parser='html'))
+
+    def test_xml(self):
+        self.assertSameResults(pq(self.xml))
+        self.assertSameResults(pq(self.xml, parser='xml'))
+
+    def test_not_simple(self):
+        d = pq(self.html)
+        for selector in ('p:first', 'div p', '.1', 'p,span', '*', '-p',
+                         '[data-k=1]'):
+            self.assertIsNone(d._simple_selector(selector))
+
+
+class TestSetEvaluation(TestCase):
+    html = '<div>%s</div>' % ''.join(
+        '<ul class="l%d"><li><a href="#%d">%d</a><ul><li><a>n</a></li></ul>'
+        '</li><!-- c --><li><span>s</span></li></ul>' % (i % 2, i, i)
+        for i in range(20))
+    selectors = ['a', 'li', 'a[href]', 'li:has(span)', 'a, span', 'ul a',
+                 'a:first', 'li:nth-child(2)', '.l1', 'ul.l1 > li']
+
+    def assertSameResults(self, selection):
+        for selector in self.selectors:
+            set_results = (selection(selector), selection.find(selector))
+            threshold = pq._set_evaluation_threshold
+            pq._set_evaluation_threshold = float('inf')
+            try:
+                expected = (selection(selector), selection.find(selector))
+            finally:
+                pq._set_evaluation_threshold = threshold
+            self.assertEqual(set_results, expected, selector)
+
+    def test_same_results(self):
+        d = pq(self.html)
+        self.assertSameResults(d('li'))
+        self.assertSameResults(d('ul'))
+        self.assertSameResults(d('ul > li') + pq(self.html)('li'))
+        d.create_index()
+        self.assertSameResults(d('li'))
+
+    def test_document_order(self):
+        d = pq(self.html)
+        # contexts out of document order, below and above the threshold
+        self.assertSameResults(d(list(reversed(d('li')))))
+        self.assertSameResults(d('ul').eq(3) + d('li').eq(0))
+        for contexts in (d('ul').eq(3) + d('li').eq(0),
+                         d(list(reversed(d('ul'))))):
+            results = contexts.find('a')
+            self.assertEqual(list(results), list(d('a').filter(
+                lambda i, e: e in results)))
+
+    def test_unique_results(self):
+        d = pq(self.html)
+        self.assertEqual(len(d('li').find('a')), 40)
+        self.assertEqual(len(d('li')('a')), 40)
+        self.assertEqual(len(d('li').eq(0)('a')), 2)
+        self.assertEqual(len(d('li')('a:first')), 40)
+
+    def test_matcher(self):
+        d = pq(self.html)
+        elements = d('*')
+        for selector in ['ul a', 'ul.l1 > li', 'a + ul', 'a ~ ul li',
+                         'li:has(span)', 'div > ul > li > a, span']:
+            expected = [e for e in elements if e in d(selector)]
+            threshold = pq._set_evaluation_threshold
+            pq._set_evaluation_threshold = float('inf')
+            try:
+                self.assertEqual(elements.filter(selector), expected)
+                self.assertEqual([e for e in elements if pq(e).is_(selector)],
+                                 expected, selector)
+            finally:
+                pq._set_evaluation_threshold = threshold
+            self.assertEqual(elements.filter(selector), expected, selector)
+
+    def test_large_tree(self):
+        d = pq('<div>%s</div>' % ('<ul><li><a>x</a></li></ul>' * 1000))
+        links = d('a')
+        # a few elements: the selector is not evaluated over the tree
+        for elements in (links[:16], links[::50], links):
+            match = d._matcher('li:has(a)', elements)
+            self.assertEqual(isinstance(getattr(match, '__self__', None),
+                                        set), elements is links)
+            self.assertEqual(len(d(elements).closest('li:has(a)')),
+                             len(elements))
+
+    def test_detached(self):
+        for count in (3, 20):
+            d = pq('<div><p>x%s</p></div>' % ('<b></b>' * count))
+            p = d('p')
+            p.remove()
+            self.assertEqual(len(p('b').closest('p:contains("x")')), 1)
+            self.assertEqual(len(p('b').filter('p:contains("x") > b')),
+                             count)
+
+
+class TestSelectMany(TestCase):
+    html = '''<div id="main" class="a"><!-- comment -->
+        <ul><li id="a" class="x">1</li><li class="x y" data-k="v">2</li></ul>
+        <p class="y">3</p><p id="a" data-k="v">4</p><div class="a"></div>
+        </div>'''
+    selectors = [('li', 'li'), ('x', '.x'), ('a', '#a'), ('pa', 'p#a'),
+                 ('k', '[data-k="v"]'), ('pk', 'p[data-k=v]'), ('y', 'p.y'),
+                 ('div', 'div'), ('da', 'div.a'), ('last', 'li:last'),
+                 ('child', 'ul > li'), ('none', '.nothing')]
+
+    def test_same_results(self):
+        d = pq(self.html)
+        found = d.select_many(self.selectors)
+        self.assertEqual(list(found), [name for name, _ in self.selectors])
+        for name, selector in self.selectors:
+            self.assertEqual(found[name], d(selector), selector)
+            self.assertIs(found[name].end(), d)
+
+    def test_with_contexts_and_index(self):
+        d = pq(self.html)
+        expected = dict((name, d('ul, p')(selector))
+                        for name, selector in self.selectors)
+        found = d('ul, p').select_many(dict(self.selectors))
+        self.assertEqual(found, expected)
+        found = d.create_index('data-k')('ul, p').select_many(
+            dict(self.selectors))
+        self.assertEqual(found, expected)
+
+    def test_nested_contexts(self):
+        d = pq('<div><div><p class="x">1</p></div><p>2</p></div>')
+        found = d('div').select_many({'p': 'p', 'x': '.x'})
+        self.assertEqual(found['p'], d('div')('p'))
+        self.assertEqual(len(found['p']), 2)
+        self.assertEqual(len(found['x']), 1)
+
+
+class TestDocumentIndex(TestCase):
+    html = '''<div id="main"><!-- comment -->
+        <ul><li id="a" class="x">1</li><li class="x y">2</li></ul>
+        <p class="y">3</p><p id="a">4</p></div>'''
+
+    def test_same_results(self):
+        d = pq(self.html)
+        indexed = pq(self.html).create_index()
+        for selector in ('#a', '.x', '.y', 'li', 'p', 'li.y', 'p#a', '#b'):
+            self.assertEqual([e.text for e in indexed(selector)],
+                             [e.text for e in d(selector)], selector)
+            self.assertEqual(
+                [e.text for e in indexed('ul').find(selector)],
+                [e.text for e in d('ul').find(selector)], selector)
+        self.assertIsNotNone(indexed('ul')._index.positions)
+
+    def test_attribute_updates(self):
+        d = pq(self.html).create_index()
+        self.assertEqual(len(d('.y')), 2)
+        d('p').add_class('y z')
+        self.assertEqual(len(d('.z')), 2)
+        self.assertEqual(len(d('.y')), 3)
+        d('li').remove_class('x')
+        self.assertEqual(d('.x'), [])
+        d('ul').attr('id', 'list')
+        d('#a').attr('class', 'x')
+        self.assertEqual(d('#list').find('.x').text(), '1')
+        d('#list').remove_attr('id')
+        self.assertEqual(d('#list'), [])
+
+    def test_structure_updates(self):
+        d = pq(self.html).create_index()
+        self.assertEqual(len(d('li')), 2)
+        d('ul').append('<li class="x">3</li>')
+        self.assertEqual(d('.x').text(), '1 2 3')
+        d('li.y').remove()
+        self.assertEqual(d('li').text(), '1 3')
+        d('ul').html('<li>new</li>')
+        self.assertEqual(d('li').text(), 'new')
+        d('ul')[0].append(etree.Element('li'))
+        d.invalidate_index()
+        self.assertEqual(len(d('li')), 2)
+
+    def test_attribute_index(self):
+        d = pq('''<ul><li data-sku="1">a</li><li data-sku="2">b</li>
+                  <li data-sku="1">c</li></ul>''').create_index('data-sku')
+        self.assertEqual(d('[data-sku="1"]').text(), 'a c')
+        self.assertEqual(d('li[data-sku=\'2\']').text(), 'b')
+        self.assertEqual(d.lookup('data-sku', '1').text(), 'a c')
+        self.assertIn('1', d._index.values['data-sku'])
+        d('li').eq(1).attr('data-sku', '1')
+        self.assertEqual(d.lookup('data-sku', '1').text(), 'a b c')
+        d('li').eq(0).remove_attr('data-sku')
+        self.assertEqual(d('[data-sku="1"]').text(), 'b c')
+        d('ul').prepend('<li data-sku="1">z</li>')
+        self.assertEqual(d.lookup('data-sku', '1').text(), 'z b c')
+        self.assertEqual(d('li').eq(1).lookup('data-sku', '1'), [])
+
+    def test_other_documents(self):
+        d = pq(self.html).create_index()
+        self.assertTrue(d('li')._index is d._index)
+        fragment = d('<ul><li class="x">5</li></ul>')
+        self.assertTrue(fragment._index is None)
+        fragment.create_index('data-k')
+        self.assertFalse(fragment._index is d._index)
+        self.assertEqual(d._index.indexed_attributes, ())
+        self.assertEqual(fragment('.x').text(), '5')
+        fragment.append('<li class="x">6</li>')
+        self.assertEqual(d('.x').text(), '1 2')
+        self.assertEqual(fragment('.x').text(), '5 6')
+
+    def test_other_wrappers(self):
+        d = pq(self.html).create_index()
+        self.assertTrue(pq(d[0][1])._index is d._index)
+        d('p').each(lambda i, e: pq(e).add_class('z'))
+        self.assertEqual(d('.z').text(), '3 4')
+        pq(d('li')[0]).remove()
+        self.assertEqual(d('.x').text(), '2')
+        pq(d('p')[1]).remove_attr('id')
+        self.assertEqual(d('#a'), [])
+        # created before the index
+        p = d('p')
+        d2 = pq(self.html)
+        p2 = d2('p')
+        d2.create_index()
+        p2.attr('id', 'b')
+        self.assertEqual(d2('#b').text(), '3 4')
+        p2.eq(0).after('<p id="b">5</p>')
+        self.assertEqual(d2('#b').text(), '3 5 4')
+        self.assertEqual(p.text(), '3 4')
+
+    def test_lookup_without_index(self):
+        d = pq(self.html)
+        self.assertEqual(d.lookup('id', 'a').text(), '1 4')
+        self.assertEqual(d.lookup('class', 'x y').text(), '2')
+
+
+class TestTraversalScaling(TestCase):
+
+    tables = {}
+
+    def table(self, size):
+        if size not in self.tables:
+            row = '<tr>%s</tr>' % ('<td>x</td>' * 10)
+            self.tables[size] = pq(
+                '<table>%s</table>' % (row * (size // 10)))('td')
+        return self.tables[size]
+
+    def duration(self, func, size):
+        cells = self.table(size)
+        durations = []
+        for i in range(3):
+            start = time.time()
+            func(cells)
+            durations.append(time.time() - start)
+        return min(durations)
+
+    def assertLinear(self, func):
+        # quadratic algorithms take 16 times longer here
+        small = self.duration(func, 25000)
+        large = self.duration(func, 100000)
+        self.assertLess(large, max(small, 0.001) * 8)
+
+    def test_results(self):
+        cells = self.table(100)
+        self.assertEqual(len(cells.parent()), 10)
+        self.assertEqual(len(cells.parents()), 11)
+        self.assertEqual(len(cells.siblings()), 100)
+        self.assertEqual(len(cells.next_all()), 90)
+        self.assertEqual(len(cells.prev_all()), 90)
+        self.assertEqual(len(cells.closest('tr')), 10)
+        self.assertEqual(cells.parent()[0], cells.parents()[1])
+        self.assertEqual(len(cells.eq(0).siblings()), 9)
+
+    def test_document_order(self):
+        d = pq('<a><b><c/></b><d/></a>')
+        self.assertEqual([e.tag for e in (d('d') + d('c')).parent()],
+                         ['a', 'b'])
+        self.assertEqual([e.tag for e in (d('d') + d('c')).parents()],
+                         ['a', 'b'])
+        d = pq('<p><b>1</b><i>2</i><b>3</b><i>4</i></p>')
+        self.assertEqual(d('i').prev_all().text(), '1 2 3')
+        self.assertEqual(d('b').next_all().text(), '2 3 4')
+        self.assertEqual(d('i').siblings('b').text(), '1 3')
+        # sibling lists of nested parents
+        d = pq('<div><ul><li>1</li><li>2</li></ul><p>3</p><p>4</p></div>')
+        self.assertEqual(
+            [e.tag for e in d('li:first, p:first').next_all()],
+            ['li', 'p'])
+        self.assertEqual(
+            [e.tag for e in d('li:last, p:last').prev_all()],
+            ['ul', 'li', 'p'])
+        self.assertEqual(
+            [e.tag for e in d('li:first, p:first').siblings()],
+            ['ul', 'li', 'p'])
+
+    def test_linear(self):
+        self.assertLinear(lambda cells: cells.parent())
+        self.assertLinear(lambda cells: cells.parents())
+        self.assertLinear(lambda cells: cells.siblings())
+        self.assertLinear(lambda cells: cells.next_all())
+        self.assertLinear(lambda cells: cells.prev_all())
+
+    def test_closest(self):
+        d = pq('<div class="a"><ul class="a"><li><b>1</b></li></ul>'
+               '<p><b>2</b></p></div>')
+        for selector in ('.a', 'ul.a, div', 'ul:first-child, div'):
+            self.assertEqual([e.tag for e in d('b').closest(selector)],
+                             ['div', 'ul'])
+            many = d('b') + d('b').parents()
+            self.assertEqual([e.tag for e in many.closest(selector)],
+                             ['div', 'ul'])
+        self.assertEqual(len(d('b').closest('form')), 0)
+        self.assertEqual(len(self.table(1000).closest('tr:nth-child(2)')), 1)
+        self.assertLinear(lambda cells: cells.closest('tr'))
+
+    def test_parents_until(self):
+        d = pq('<div><ul><li><b>1</b><i>2</i></li></ul></div>')
+        self.assertEqual([e.tag for e in d('b, i').parents_until('div')],
+                         ['ul', 'li'])
+        self.assertEqual([e.tag for e in d('b').parentsUntil('ul')], ['li'])
+        self.assertEqual([e.tag for e in d('b').parents_until()],
+                         ['div', 'ul', 'li'])
+        self.assertEqual([e.tag for e in d('b').parents_until('x', 'ul')],
+                         ['ul'])
+        self.assertEqual(len(self.table(1000).parents_until('table')), 100)
+
+
+class TestLazyIteration(TestCase):
+    html = ('<div id="a"><ul class="x"><li class="x">1</li>'
+            '<li><a href="q">2</a></li></ul><p lang="en-us">t</p>'
+            '<!-- c --></div>')
+
+    def test_same_elements(self):
+        d = pq(self.html)
+        selectors = ['li', '.x', '[href=q]', 'li.x', 'ul > li', 'li:first',
+                     'a[href^=q]', ':lang(en)', 'li, p', '*', 'ul li',
+                     'div > ul a', 'ul li, p', 'li + li', 'ul ~ p',
+                     'div li:first']
+        for selection in (d, d('ul, li, p'), d('li') + d('ul')):
+            for selector in selectors:
+                expected = set(selection(selector))
+                results = list(selection.iter(selector))
+                self.assertEqual(len(results), len(expected), selector)
+                self.assertEqual(set(results), expected, selector)
+        self.assertEqual(list(d.iter()), list(d))
+
+    def test_items(self):
+        d = pq(self.html)
+        self.assertEqual([i.text() for i in d.iteritems('li')], ['1', '2'])
+        self.assertEqual([i.text() for i in d.items('li', lazy=True)],
+                         ['1', '2'])
+        item = next(d.iteritems('li'))
+        self.assertTrue(isinstance(item, pq))
+        self.assertTrue(item._parent is d)
+
+    def test_first_result(self):
+        row = '<tr>%s</tr>' % ('<td>x</td>' * 10)
+        d = pq('<table>%s</table>' % (row * 10000))
+        for selector in ('td', 'td:contains(x)', 'table td', 'tr > td'):
+            start = time.time()
+            d(selector)
+            eager = time.time() - start
+            start = time.time()
+            next(d.iter(selector))
+            self.assertLess(time.time() - start, eager / 10)
+
+
+class TestLimit(TestCase):
+    html = ('<div><p><b>1</b></p><i><b>2</b><p><b>3</b></p></i>'
+            '<meta property="og:title" content="t"/></div>')
+
+    def test_same_elements(self):
+        import pyquery
+        d = pq(self.html)
+        selectors = ['b', 'p b', 'i > b', 'b:last', 'b:contains("3")',
+                     'b, p', pyquery.compile('p b')]
+        for selection in (d, d('i, p'), d('p') + d('i')):
+            for selector in selectors:
+                # like jquery, the first elements in document order
+                expected = document_order(selection.find(selector))
+                for limit in (1, 2, 5):
+                    results = selection.find(selector, limit=limit)
+                    self.assertEqual(list(results), expected[:limit])
+                self.assertEqual(len(selection.find(selector, limit=0)), 0)
+        self.assertEqual(list(d('b', limit=2)), list(d('b')[:2]))
+        self.assertEqual(pq('b', self.html, limit=1).text(), '1')
+
+    def test_first(self):
+        d = pq(self.html)
+        self.assertEqual(
+            d.first('meta[property="og:title"]').attr('content'), 't')
+        self.assertEqual(d('b').first().text(), '1')
+        self.assertEqual(d('i').first('b').text(), '2')
+        self.assertEqual(len(d.first('form')), 0)
+        self.assertEqual(d('i').find_one('b').text(), '2')
+        self.assertEqual(len(d('b').find_one('b')), 0)
+
+
+class TestExistsCount(TestCase):
+    html = ('<div><p class="a"><b>1</b></p><i><b>2</b><p><b>3</b></p></i>'
+            '<!-- c --></div>')
+
+    def test_same_results(self):
+        import pyquery
+        d = pq(self.html)
+        selectors = ['b', 'p b', 'i > b', 'b:last', 'b:contains("3")',
+                     'b, p', '.a', 'p.a b', 'form', pyquery.compile('p b')]
+        for selection in (d, d('i, p'), d('p') + d('i'), d.contents()):
+            for selector in selectors:
+                expected = selection(selector)
+                self.assertEqual(selection.count(selector), len(expected))
+                self.assertEqual(selection.exists(selector), bool(expected))
+        self.assertEqual(d('b').count(), 3)
+        self.assertTrue(d('b').exists())
+        self.assertFalse(d('form').exists())
+
+    def test_list_count(self):
+        d = pq(self.html)('b')
+        self.assertEqual(d.count(d[0]), 1)
+        texts = d.map(lambda i, e: 'Hi')
+        self.assertEqual(texts.count('Hi'), len(d))
+        self.assertEqual(texts.count('b'), 0)
+
+    def test_with_index(self):
+        d = pq(self.html)
+        d.create_index()
+        self.assertEqual(d('i, p').count('b'), 3)
+        self.assertTrue(d.exists('.a'))
+
+    def test_is_has_class(self):
+        d = pq(self.html)
+        self.assertTrue(d('p').is_('.a'))
+        self.assertTrue(d('p').is_('p:first'))
+        self.assertFalse(d('p').is_('b'))
+        self.assertTrue(d('p').has_class('a'))
+        self.assertFalse(d('b').has_class('a'))
+        self.assertFalse(d.contents().eq(2).has_class('a'))
+
+
+class TestDerive(TestCase):
+
+    def test_attributes(self):
+        d = pq('<foo xmlns:bar="http://bar"><bar:b>1</bar:b></foo>',
+               parser='xml', namespaces={'bar': 'http://bar'})
+        for result in (d('bar|b'), d.children(), d.eq(0), d.find('bar|b'),
+                       next(d.items())):
+            self.assertTrue(result._parent is d)
+            self.assertTrue(result._translator is d._translator)
+            self.assertEqual(result.namespaces, d.namespaces)
+            self.assertEqual(result.parser, None)
+            self.assertEqual(result.end(), d)
+        self.assertEqual(d('bar|b').text(), '1')
+
+    def test_subclass(self):
+        class MyQuery(pq):
+            def __init__(self, *args, **kwargs):
+                self.initialized = True
+                super(MyQuery, self).__init__(*args, **kwargs)
+
+        d = MyQuery('<p><b>1</b></p>')
+        for result in (d('b'), d.children(), d.eq(0)):
+            self.assertTrue(isinstance(result, MyQuery))
+            self.assertTrue(result.initialized)
+
+
+class TestFlexibleElement(TestCase):
+
+    def test_no_class_per_access(self):
+        d = pq('<a href="#" title="t">x</a>')
+        self.assertTrue(type(d.attr) is type(pq('<b/>').attr))
+        self.assertTrue(type(d.attr) is type(d.css))
+        self.assertEqual(repr(d.attr), '<flexible_element attr>')
+
+    def test_access(self):
+        d = pq('<a href="#" title="t">x</a>')
+        self.assertEqual(d.attr.href, '#')
+        self.assertEqual(d.attr['title'], 't')
+        d.attr.rel = 'next'
+        d.attr['lang'] = 'en'
+        self.assertEqual(d.attr('rel'), 'next')
+        self.assertEqual(d.attr.lang, 'en')
+        del d.attr.rel
+        del d.attr['lang']
+        self.assertEqual(d.attr.rel, None)
+        self.assertEqual(d.attr.lang, None)
+        d.css.color = 'red'
+        self.assertEqual(d.attr.style, 'color: red')
+        self.assertRaises(NotImplementedError, d.css.__delitem__, 'color')
+
+
+class TestImport(TestCase):
+
+    def run_python(self, *args):
+        import subprocess
+        return subprocess.check_output(
+            (sys.executable,) + args, stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(dirname), universal_newlines=True)
+
+    def imported_modules(self, code):
+        return self.run_python(
+            '-c', code + '; import sys; print(" ".join(sys.modules))').split()
+
+    def test_lazy_imports(self):
+        modules = self.imported_modules('import pyquery')
+        self.assertTrue('pyquery.pyquery' in modules)
+        for name in ('requests', 'urllib.request', 'urllib2', 'lxml.html'):
+            self.assertFalse(name in modules, name)
+        # parsing xml needs neither
+        modules = self.imported_modules(
+            'import pyquery; pyquery.PyQuery("<a><b/></a>", parser="xml")')
+        for name in ('requests', 'lxml.html'):
+            self.assertFalse(name in modules, name)
+        modules = self.imported_modules(
+            'import pyquery; pyquery.PyQuery("<p>a</p>", parser="html")')
+        self.assertTrue('lxml.html' in modules)
+
+    def test_opener(self):
+        from pyquery import openers
+        self.assertEqual(openers.HAS_REQUEST, HAS_REQUEST)
+        output = self.run_python(
+            '-c', 'import pyquery.openers as o; print(o.HAS_REQUEST)')
+        self.assertEqual(output.strip(), str(HAS_REQUEST))
+
+
+class TestIterparse(TestCase):
+    xml = (b'<feed><meta><p id="0"/></meta>' +
+           b''.join(b'<p id="%d"><b>%d</b><p id="n%d"/></p>' % (i, i, i)
+                    for i in range(1, 501)) + b'</feed>')
+
+    def iterparse(self, selector, source=None, **kwargs):
+        from io import BytesIO
+        from pyquery import iterparse
+        return iterparse(BytesIO(source or self.xml), selector, **kwargs)
+
+    def test_records(self):
+        ids = [p.attr('id') for p in self.iterparse('p')]
+        self.assertEqual(len(ids), 1001)
+        self.assertEqual(ids[:4], ['0', 'n1', '1', 'n2'])
+        records = self.iterparse('p:has(b)')
+        self.assertEqual([p.text() for p in islice(records, 3)],
+                         ['1', '2', '3'])
+
+    def test_combinators(self):
+        ids = [p.attr('id') for p in self.iterparse('feed > p')]
+        self.assertEqual(ids, [str(i) for i in range(1, 501)])
+        ids = [p.attr('id') for p in self.iterparse('meta p, p > p')]
+        self.assertEqual(ids[:3], ['0', 'n1', 'n2'])
+        self.assertEqual(len(ids), 501)
+
+    def test_nested(self):
+        records = [(p.attr('id'), p.children('p').attr('id'))
+                   for p in self.iterparse('p[id]')]
+        self.assertEqual(records[1:3], [('n1', None), ('1', 'n1')])
+
+    def test_memory(self):
+        # lxml parses ahead of the events: only a part of the document can
+        # be removed
+        xml = b'<feed>' + b'<p><b>x</b></p>' * 20000 + b'</feed>'
+        sizes = []
+        for i, p in enumerate(self.iterparse('feed > p', xml)):
+            if i % 1000 == 999:
+                feed = p.parent()
+                sizes.append(len(feed) + len(feed('*')))
+            if i:
+                # only the previous record is left, cleared
+                self.assertEqual(p.prev().children(), [])
+                self.assertEqual(p.prev().prev(), [])
+        self.assertLess(max(sizes), 20000)
+
+    def test_memory_nested(self):
+        group = b'<group><p><b>x</b></p><x><y/></x><x/></group>'
+        xml = (b'<feed>' + group * 5000 + b'<x><y/></x>' * 20000 +
+               b'</feed>')
+        sizes = []
+        for i, p in enumerate(self.iterparse('group p', xml)):
+            root = p[0].getroottree().getroot()
+            if i % 1000 == 999:
+                sizes.append(len(list(root.iter())))
+        self.assertEqual(i, 4999)
+        self.assertLess(max(sizes), 5000)
+        # non matching elements after the last match
+        self.assertLess(len(list(root.iter())), 5000)
+
+    def test_html(self):
+        html = b'<html><body><div><P>a<P>b</div></body></html>'
+        texts = [p.text() for p in self.iterparse('div p', html,
+                                                  parser='html')]
+        self.assertEqual(texts, ['a', 'b'])
+
+    def test_parser(self):
+        self.assertRaises(ValueError, list, self.iterparse('p', parser='x'))
+
+
+class TestFeedParser(TestCase):
+
+    def feed(self, chunks, **kwargs):
+        found = []
+        parser = pq.feed_parser(**kwargs)
+        parser.on('p > b', lambda b: found.append(b.text()))
+        for chunk in chunks:
+            parser.feed(chunk)
+        return parser.close(), found
+
+    def test_chunks(self):
+        html = b'<div><p><b>1</b></p><b>2</b><p>x<b>3</b></p></div>'
+        d, found = self.feed(html[i:i + 3] for i in range(0, len(html), 3))
+        self.assertEqual(d('div').outer_html(), pq(html).outer_html())
+        self.assertEqual(found, ['1', '3'])
+
+    def test_dispatch(self):
+        found = []
+        parser = pq.feed_parser().on('p', lambda p: found.append(p.text()))
+        parser.feed(b'<p>a</p><p>b')
+        self.assertEqual(found, ['a'])
+        parser.feed(b'</p>')
+        self.assertEqual(found, ['a', 'b'])
+        parser.close()
+        self.assertEqual(found, ['a', 'b'])
+
+    def test_xml(self):
+        xml = b'<r xmlns:x="urn:x"><p><b>1</b></p><x:b>2</x:b></r>'
+        d, found = self.feed([xml[:10], xml[10:]], parser='xml',
+                             namespaces={'x': 'urn:x'})
+        self.assertEqual(d[0].tag, 'r')
+        self.assertEqual(d('x|b').text(), '2')
+        self.assertEqual(found, ['1'])
+
+    def test_encoding(self):
+        html = u'<p><b>\xe9t\xe9</b></p>'.encode('latin-1')
+        d, found = self.feed([html], encoding='iso-8859-1')
+        self.assertEqual(found, [u'\xe9t\xe9'])
+
+    def test_class(self):
+        class Sub(pq):
+            pass
+        parser = Sub.feed_parser()
+        parser.feed(b'<p>')
+        self.assertTrue(isinstance(parser.close(), Sub))
+        self.assertRaises(ValueError, pq.feed_parser, parser='x')
+
+
+class TestSniffParser(TestCase):
+    html = [
+        '<!doctype html><html></html>',
+        '<!DocType html><html></html>',
+        'Hello <b>world</b>',
+        '<html><p>a&nbsp;b</p></html>',
+        '<?xml version="1.0"?>\n<!-- c --><html><p>&copy;</p></html>',
+        '<html><ul><li><img src="a/b.png" alt=">"></li></ul></html>',
+        '<!DOCTYPE html><div>a<br>b</div>',
+    ]
+    unknown = [
+        '<p>a</p>',
+        '<p>a&nbsp;<br></p>',
+        '<!DOCTYPE html><p>a&amp;&#160;&#xA0;</p>',
+        '<!DOCTYPE html [<!ENTITY nbsp "&#160;">]><p>&nbsp;</p>',
+        '<html><!-- &nbsp; <br></p> --><![CDATA[<br></p>]]></html>',
+        '<html><br/><br></br><img src="a"/></html>',
+        '<html><meta charset="utf-8"><title>x</title></html>',
+        '',
+    ]
+
+    def test_sniff(self):
+        from pyquery.sniff import sniff_parser
+        for html in self.html:
+            self.assertEqual(sniff_parser(html), 'html', html)
+            self.assertEqual(sniff_parser(html.encode('utf-8')), 'html')
+            self.assertRaises(etree.XMLSyntaxError, etree.fromstring, html)
+        for html in self.unknown:
+            self.assertEqual(sniff_parser(html), None, html)
+        self.assertEqual(sniff_parser(u'<p>&nbsp;</p>'.encode('utf-16')),
+                         None)
+
+    def test_file(self):
+        from io import BytesIO
+        from pyquery.pyquery import fromstring
+        from pyquery.sniff import sniff_parser
+        fd = BytesIO(b'<x/><html>a<br></html>')
+        fd.seek(4)
+        self.assertEqual(sniff_parser(fd), 'html')
+        self.assertEqual(fd.tell(), 4)
+        self.assertEqual(fromstring(fd)[0].tag, 'html')
+
+    def test_document_parser(self):
+        for html in self.html[1:]:
+            d = pq(html)
+            self.assertEqual(d.document_parser, 'html')
+            self.assertEqual(d.outer_html(),
+                             pq(html, parser='html').outer_html())
+        self.assertEqual(pq('<p>a</p>').document_parser, 'xml')
+        self.assertEqual(pq('<p>a</p>', parser='html').document_parser,
+                         'html')
+        self.assertEqual(pq('<p>a</p>')('p').document_parser, None)
+        self.assertEqual(pq(filename=path_to_html_file).document_parser,
+                         'xml')
+
+
+class TestParserOptions(TestCase):
+    xml = '<a>\n  <b id="1"/> <!-- c -->\n</a>'
+    options = {'remove_blank_text': True, 'remove_comments': True}
+
+    def test_xml(self):
+        d = pq(self.xml, parser='xml', parser_options=self.options)
+        self.assertEqual(str(d), '<a><b id="1"/></a>')
+        d = pq(self.xml, parser_options=self.options)
+        self.assertEqual(d.document_parser, 'xml')
+        self.assertEqual(str(d), '<a><b id="1"/></a>')
+        self.assertEqual(str(pq(self.xml)), self.xml)
+
+    def test_html(self):
+        html = '<div><p>a&nbsp;</p><!-- c --></div>'
+        for parser in ('html', 'html_fragments', None):
+            d = pq(html, parser=parser, parser_options=self.options)
+            self.assertEqual(d.outer_html(), u'<div><p>a\xa0</p></div>')
+            d.append('<i>x</i><!-- c -->')
+            self.assertEqual(d.html(), u'<p>a\xa0</p><i>x</i>')
+        self.assertRaises(ValueError, pq, html, parser='soup',
+                          parser_options=self.options)
+
+    def test_html_only_options(self):
+        d = pq('<div><p>a</p></div>', parser_options={
+            'default_doctype': False, 'remove_comments': True})
+        self.assertEqual(d.document_parser, 'html')
+        self.assertEqual(d('p').text(), 'a')
+
+    def test_derived_objects(self):
+        d = pq('<div><p>a</p><p>b</p></div>', parser_options=self.options)
+        d('p').append('<i>x</i><!-- c -->')
+        self.assertEqual(d('p').eq(0).html(), 'a<i>x</i>')
+        d('p:last').html('<b>y</b><!-- c -->')
+        self.assertEqual(d('p').eq(1).html(), '<b>y</b>')
+        self.assertEqual(d.children().eq(0).parser_options, self.options)
+        self.assertEqual(d.find('p').parser_options, self.options)
+
+    def test_registry(self):
+        import threading
+        from pyquery.parsers import get_parser
+        parser = get_parser('xml', self.options)
+        self.assertTrue(parser is get_parser('xml', dict(self.options)))
+        self.assertFalse(parser is get_parser('xml', {}))
+        self.assertFalse(parser is get_parser('html', self.options))
+        parsers = []
+        thread = threading.Thread(
+            target=lambda: parsers.append(get_parser('xml', self.options)))
+        thread.start()
+        thread.join()
+        self.assertFalse(parser is parsers[0])
+
+
+class TestDocumentCache(TestCase):
+    html = '<div><p class="a">a&nbsp;</p><p>b<br></p></div>'
+
+    def setUp(self):
+        document_cache.clear()
+        document_cache.maxsize = 2 ** 20
+        # short documents would be fragments
+        self.fragment_cache_maxsize = fragment_cache.maxsize
+        fragment_cache.maxsize = 0
+
+    def tearDown(self):
+        document_cache.clear()
+        document_cache.maxsize = 0
+        fragment_cache.maxsize = self.fragment_cache_maxsize
+
+    def test_copies(self):
+        d = pq(self.html)
+        d('p').remove()
+        for i in range(2):
+            d = pq(self.html)
+            self.assertEqual(d.outer_html(), pq(self.html).outer_html())
+            self.assertEqual(d.document_parser, 'html')
+            self.assertEqual(len(d('p')), 2)
+        info = document_cache.info()
+        self.assertEqual((info.hits, info.misses), (4, 1))
+        self.assertEqual(info.currsize, len(self.html) + 256 * 7)
+
+    def test_keys(self):
+        html = '<a><!-- c --><b></b></a>'
+        self.assertEqual(len(pq(html, parser='html')[0]), 2)
+        self.assertEqual(len(pq(html.encode('utf-8'), parser='html')[0]), 2)
+        self.assertEqual(len(pq(html, parser='html', parser_options={
+            'remove_comments': True})[0]), 1)
+        self.assertEqual(len(pq(html, parser='html_fragments')[0]), 2)
+        self.assertEqual(document_cache.info().misses, 4)
+
+    def test_xml(self):
+        pq('<a><b/></a>', parser='xml')
+        pq('<a><b/></a>')
+        self.assertEqual(len(document_cache), 0)
+
+    def test_fragments(self):
+        for i in range(2):
+            d = pq('<p>a</p>', parser='html')
+            self.assertEqual(d[0].getparent().tag, 'body')
+            d = pq('x<p>a</p><i>b</i>', parser='html_fragments')
+            self.assertEqual(d[0], 'x')
+            self.assertEqual([e.tag for e in d[1:]], ['p', 'i'])
+            self.assertTrue(d[1].getparent() is d[2].getparent())
+        self.assertEqual(document_cache.info().hits, 2)
+
+    def test_size(self):
+        # 520 bytes each
+        document_cache.maxsize = 1600
+        for i in range(5):
+            pq('<p>%s</p>' % i, parser='html')
+        self.assertEqual(len(document_cache), 3)
+        self.assertEqual(document_cache.info().evictions, 2)
+        pq('<p>%s</p>' % ('x' * 2000), parser='html')
+        self.assertEqual(len(document_cache), 3)
+
+    def test_disabled(self):
+        document_cache.maxsize = 0
+        pq(self.html)
+        self.assertEqual(len(document_cache), 0)
+        self.assertEqual(document_cache.info().misses, 0)
+
+
+class TestFragmentCache(TestCase):
+
+    def setUp(self):
+        fragment_cache.clear()
+
+    def tearDown(self):
+        fragment_cache.clear()
+
+    def test_manipulation(self):
+        d = pq('<ul><li>a</li><li>b</li></ul>')
+        for i in range(3):
+            d('li').append('<b class="x">!</b>')
+            d('b').wrap('<i></i>')
+            d.wrap_all('<div></div>')
+            d('li').eq(0).html('<em>c</em>')
+        self.assertEqual(len(d('em')), 1)
+        self.assertEqual(len(d('b')), 3)
+        self.assertEqual(len(d('i > b')), 3)
+        info = fragment_cache.info()
+        self.assertEqual(len(fragment_cache), 5)
+        self.assertEqual(info.misses, 5)
+        self.assertEqual(info.hits, 8)
+
+    def test_copies(self):
+        first = pq('<tr><td>a</td></tr>')
+        first('td').text('b')
+        second = pq('<tr><td>a</td></tr>')
+        self.assertEqual(second.text(), 'a')
+        self.assertFalse(first[0] is second[0])
+        self.assertEqual(fragment_cache.info().hits, 1)
+
+    def test_keys(self):
+        html = '<a><!-- c --><b></b></a>'
+        self.assertEqual(len(pq(html)[0]), 2)
+        self.assertEqual(len(pq(html, parser='html')[0]), 2)
+        self.assertEqual(len(pq(html, parser_options={
+            'remove_comments': True})[0]), 1)
+        self.assertEqual(pq(html).document_parser, 'xml')
+        self.assertEqual(pq('<a>&nbsp;</a>').document_parser, 'html')
+        self.assertEqual(pq('<a>&nbsp;</a>').document_parser, 'html')
+        self.assertEqual(fragment_cache.info().misses, 4)
+
+    def test_length(self):
+        html = '<p>%s</p>' % ('x' * cache.fragment_max_length)
+        pq(html)
+        self.assertEqual(len(fragment_cache), 0)
+
+
+class TestQueryFiles(TestCase):
+
+    selectors = {'title': 'h1', 'links': ('a', '@href'),
+                 'body': ('p', 'outer_html')}
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(20):
+            path = os.path.join(self.dirname, '%02d.html' % i)
+            with open(path, 'w') as fd:
+                fd.write('<html><h1>%d</h1><p><a href="/%d">x</a></p>'
+                         '<a href="/">y</a></html>' % (i, i))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def check(self, results):
+        self.assertEqual(len(results), len(self.paths))
+        for i, (path, result) in enumerate(results):
+            self.assertEqual(path, self.paths[i])
+            self.assertEqual(result['title'], [str(i)])
+            self.assertEqual(result['links'], ['/%d' % i, '/'])
+            self.assertEqual(result['body'],
+                             ['<p><a href="/%d">x</a></p>' % i])
+
+    def test_ordered(self):
+        self.check(list(query_files(self.paths, self.selectors, workers=2,
+                                    chunksize=3)))
+
+    def test_unordered(self):
+        results = list(query_files(iter(self.paths), self.selectors,
+                                   workers=3, chunksize=1, ordered=False))
+        self.check(sorted(results))
+
+    def test_in_process(self):
+        self.check(list(query_files(self.paths, self.selectors, workers=0)))
+
+    def test_error(self):
+        paths = self.paths + [os.path.join(self.dirname, 'missing')]
+        with self.assertRaises(EnvironmentError):
+            list(query_files(paths, self.selectors, workers=2))
+        with self.assertRaises(ValueError):
+            list(query_files(self.paths, {'title': ('h1', 'tail')},
+                             workers=2))
+
+    def test_unpicklable_arguments(self):
+        with self.assertRaises(TypeError):
+            list(query_files(self.paths, self.selectors, workers=1,
+                             parser_options={'target': threading.Lock()}))
+
+    def test_timeout(self):
+        if not hasattr(os, 'mkfifo'):
+            self.skipTest('no named pipes')
+        # opening a pipe without writer blocks the worker
+        path = os.path.join(self.dirname, 'pipe')
+        os.mkfifo(path)
+        with self.assertRaises(multiprocessing.TimeoutError):
+            list(query_files([path], self.selectors, workers=1, timeout=.5))
+
+    def test_backpressure(self):
+        consumed = []
+
+        def paths():
+            for path in self.paths:
+                consumed.append(path)
+                yield path
+
+        results = query_files(paths(), self.selectors, workers=2,
+                              chunksize=2, window=3)
+        self.assertEqual(next(results)[0], self.paths[0])
+        # 3 chunks of 2 paths
+        self.assertEqual(len(consumed), 6)
+        self.assertEqual(len(list(results)), 19)
+        self.assertEqual(len(consumed), 20)
+
+
 class TestOpener(TestCase):
 
     def test_open_filename(self):
@@ -329,6 +1373,10 @@ class TestComment(TestCase):
         self.assertEqual(doc.text(), 'bar')
 
 
+def callback_helper():
+    return pq(this).html()  # NOQA
+
+
 class TestCallback(TestCase):
     html = """
         <ol>
@@ -348,6 +1396,100 @@ class TestCallback(TestCase):
         self.assertEqual(S('li').map(lambda: S(this).html()),  # NOQA
                                      ['Coffee', 'Tea', 'Milk'])
 
+    def test_this_out_of_callbacks(self):
+        S = pq(self.html)
+        S('li').each(lambda i, el: S(this).html())  # NOQA
+        with self.assertRaises(NameError):
+            this.tag  # NOQA
+
+    def test_lxml_elements(self):
+        S = pq(self.html)
+        self.assertEqual(
+            S('li').map(lambda: isinstance(this, etree._Element)),  # NOQA
+            [True, True, True])
+        self.assertEqual(S('li').map(lambda: etree.tostring(this)),  # NOQA
+                         [b'<li>Coffee</li>\n            ',
+                          b'<li>Tea</li>\n            ',
+                          b'<li>Milk</li>\n        '])
+        S('li').each(lambda: this.getparent().remove(this))  # NOQA
+        self.assertEqual(S('li'), [])
+
+    def test_previous_value(self):
+        S = pq(self.html)
+        global this
+        this = 'global'
+        try:
+            S('li').each(lambda: this.tag)
+            self.assertEqual(this, 'global')
+        finally:
+            del this
+
+    def test_module_globals(self):
+        S = pq(self.html)
+        global callback_calls
+        callback_calls = 0
+
+        def count(i, el):
+            global callback_calls
+            callback_calls += 1
+        S('li').each(count)
+        self.assertEqual(callback_calls, 3)
+        self.assertEqual(S('li').map(lambda i: callback_helper()),
+                         ['Coffee', 'Tea', 'Milk'])
+
+    def test_nested_callbacks(self):
+        S = pq(self.html)
+
+        def outer(i, el):
+            inner = S(this).map(lambda: this)  # NOQA
+            return this is el and inner[0] is el  # NOQA
+        self.assertEqual(S('li').map(outer), [True, True, True])
+
+    def test_callables(self):
+        S = pq(self.html)
+
+        class Callbacks(object):
+            def text(self, i, el):
+                return S(this).html()  # NOQA
+
+            def index(self, *args):
+                return args[0]
+        callbacks = Callbacks()
+        self.assertEqual(S('li').map(callbacks.text),
+                         ['Coffee', 'Tea', 'Milk'])
+        self.assertEqual(S('li').map(callbacks.index), [0, 1, 2])
+        self.assertEqual(S('li').filter(lambda i, this: i == 1).html(), 'Tea')
+        tea = S('li').filter(lambda i: S(this).html() == 'Tea')  # NOQA
+        self.assertEqual(tea.html(), 'Tea')
+
+    def test_threads(self):
+        S = pq('<ul>%s</ul>' % ('<li>x</li>' * 2000))
+        items = S('li')
+        errors = []
+
+        def run():
+            try:
+                results = items.map(lambda i, el: this is el)  # NOQA
+            except NameError as e:
+                errors.append(e)
+            else:
+                if not all(results):
+                    errors.append(results.count(False))
+        threads = [threading.Thread(target=run) for i in range(8)]
+        if PY3k:
+            # switch threads often to make races likely
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if PY3k:
+                sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+
 
 class TestHook(TestCase):
     html = """
@@ -590,6 +1732,36 @@ Bacon</textarea>
         self.assertEqual(new_html, expected)
         self.assertIn(replacement, new_html)
 
+    def test_many_targets(self):
+        html = '<div><p>a</p><p>b</p><p>c</p></div>'
+        fragment = 't<i>x</i>u<b>y</b>v'
+        expected = {
+            'html': '<p>%s</p>' % fragment,
+            'append': '<p>a%s</p>' % fragment,
+            'prepend': '<p>%sa</p>' % fragment,
+            'before': '%s<p>a</p>' % fragment,
+            'after': '<p>a</p>%s' % fragment,
+        }
+        for method, first in expected.items():
+            d = pq(html)
+            getattr(d('p'), method)(fragment)
+            self.assertEqual(len(d('i')), 3, method)
+            self.assertEqual(len(d('b')), 3, method)
+            self.assertIn(first, str(d), method)
+        d = pq(html)
+        d('p').html(fragment)
+        d('i').eq(0).text('z')
+        self.assertEqual(d('i').text(), 'z x x')
+
+    def test_many_targets_moves_to_last(self):
+        d = pq('<div><p>a</p><p>b</p></div>')
+        source = pq('<section><em>1</em><em>2</em></section>')
+        ems = source('em')
+        d('p').append(ems)
+        self.assertEqual(len(source('em')), 0)
+        self.assertEqual(len(d('em')), 4)
+        self.assertEqual(ems[0].getparent(), d('p')[1])
+
 
 class TestAjax(TestCase):
 